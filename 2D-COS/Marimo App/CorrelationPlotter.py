@@ -21,29 +21,31 @@ def _(mo):
 @app.cell
 def _():
     import gc
-    import math
+    import os
     import tabulate
+    import cos_engine
+    import spectra_io
     import numpy as np
     import marimo as mo
     import pandas as pd
     from matplotlib import colors
+    from matplotlib import ticker
     import matplotlib.pyplot as plt
-    from pybaselines import polynomial
-    from scipy.signal import savgol_filter
     from matplotlib.gridspec import GridSpec
     from matplotlib.colors import LinearSegmentedColormap
     from mpl_toolkits.axes_grid1 import make_axes_locatable
     return (
         GridSpec,
         colors,
+        cos_engine,
         gc,
-        math,
         mo,
         np,
+        os,
         pd,
         plt,
-        polynomial,
-        savgol_filter,
+        spectra_io,
+        ticker,
     )
 
 
@@ -52,23 +54,33 @@ def _(
     BGC2_toggle,
     BGC_toggle,
     GridSpec,
-    colors,
     contour_number,
+    cos_engine,
     gc,
-    math,
     mo,
     np,
+    os,
     pd,
     plt,
-    polynomial,
-    savgol_filter,
+    spectra_io,
+    ticker,
 ):
     def read_data(hetero, Input_path1, Input_path2, Correlation_path):
+        if Correlation_path.endswith(cos_engine.MAP_SUFFIX):
+            # Binary maps are memory-mapped, nothing is read until it is drawn
+            Corre_x, Corre_y, Corre_d = cos_engine.open_map(Correlation_path)
+            spect1 = cos_engine.open_map(Input_path1)[1:]
+            spect2 = cos_engine.open_map(Input_path2)[1:] if hetero else None
+
+            Correlation = [Corre_x, Corre_y, Corre_d]
+            Input = [spect1[0], spect1[1].mean(axis=1),
+                     spect2[0] if hetero else None, spect2[1].mean(axis=1) if hetero else None]
+
+            return Correlation, Input, spect1, spect2
+
         Input_dat1 = pd.read_csv(Input_path1, skiprows=1, header=None)
         Input_dat2 = pd.read_csv(Input_path2, skiprows=1, header=None) if hetero else None
         Corre_data = pd.read_csv(Correlation_path, header=None)
-        spect1 = pd.read_csv(Input_path1, header=None)
-        spect2 = pd.read_csv(Input_path2, header=None) if hetero else None
 
         Corre_x = Corre_data.iloc[0, 1:].astype(float).values
         Corre_y = Corre_data.iloc[1:, 0].astype(float).values
@@ -78,24 +90,23 @@ def _(
         I_val1 = Input_dat1.iloc[:, 1:]
         I_Avg1 = I_val1.mean(axis=1)
 
+        spect1 = (I_wav1.values, I_val1.values)
+
         if hetero:
             I_wav2 = Input_dat2.iloc[:, 0]
             I_val2 = Input_dat2.iloc[:, 1:]
             I_Avg2 = I_val2.mean(axis=1)
+            spect2 = (I_wav2.values, I_val2.values)
         else:
             I_wav2 = None
             I_Avg2 = None
+            spect2 = None
 
         Correlation = [Corre_x, Corre_y, Corre_d]
         Input = [I_wav1, I_Avg1, I_wav2, I_Avg2]
 
         return Correlation, Input, spect1, spect2 
 
-    def normalize(df):
-        cols = df.columns[1:]
-        df[cols] = (df[cols] - df[cols].min()) / (df[cols].max() - df[cols].min())
-        return df
-
     def init_figure(title):
         fig = plt.figure(figsize=(10, 10))
         fig.suptitle(title, fontsize=16, y=0.95)
@@ -121,10 +132,12 @@ def _(
 
         def on_main_xlim_changed(ax):
             ax_T.set_xlim(ax.get_xlim())
+            refresh_detail(fig)
             fig.canvas.draw_idle()
 
         def on_main_ylim_changed(ax):
             ax_L.set_ylim(ax.get_ylim())
+            refresh_detail(fig)
             fig.canvas.draw_idle()
 
         ax_main.callbacks.connect('xlim_changed', on_main_xlim_changed)
@@ -132,145 +145,146 @@ def _(
 
         return fig
 
-    # def baseline_correction(df, degree=2):
-    #     # print(degree_val)
-    #     corrected = df.copy()
-    #     x = corrected.iloc[:, 0].values
-
-    #     for col in corrected.columns[1:]:
-    #         y = corrected[col].values
-    #         coeffs = np.polyfit(x, y, deg=degree)
-    #         baseline = np.polyval(coeffs, x)
-    #         corrected[col] = y - baseline       
-
-    #     return corrected
-
-    def baseline_correction(df, degree=2, mode=False):
-
-        if mode:
-            corrected = df.copy()
-            x = corrected.iloc[:, 0].values
-
-            for col in corrected.columns[1:]:
-                y = corrected[col].values
-                coeffs = np.polyfit(x, y, deg=degree)
-                baseline = np.polyval(coeffs, x)
-                corrected[col] = y - baseline  
-        else:
-
-            corrected = df.copy()
-
-            for col in corrected.columns[1:]:
-                y = corrected[col].values
-                baseline, params = polynomial.modpoly(y, poly_order=degree)
-                corrected[col] = y - baseline
-
-        return corrected
-
-    def smooth_data(df, window_length=5, polyorder=2):
-        smoothed = df.copy()
-        for col in smoothed.columns[1:]:
-            smoothed[col] = savgol_filter(smoothed[col], window_length=window_length, polyorder=polyorder)
-        return smoothed    
+    def preprocessing_stages(i, Normalize, BGC, Smooth, degree, smoothness, length, mode, workers):
+        """(name, title, cache parameters, in-place function) for every enabled correction of spectra set i."""
+        which = ["First", "Second"][i]
+        normalize = (f"Normalize {i + 1}", f"Normalizing {which} Spectra Set", ("normalize",),
+                     lambda x, y: cos_engine.normalize_spectra(y))
+        baseline = (f"Baseline {i + 1}", f"Applying Background Correction to the {which} Spectra Set",
+                    ("baseline", degree[i], mode),
+                    lambda x, y: cos_engine.baseline_correct(x, y, degree=degree[i], mode=mode, workers=workers))
+        smooth = (f"Smooth {i + 1}", f"Smoothing the {which} Spectra Set", ("smooth", length[i], smoothness[i]),
+                  lambda x, y: cos_engine.smooth_spectra(y, window_length=length[i], polyorder=smoothness[i],
+                                                         workers=workers))
+
+        # The second set has always been normalized before the other corrections
+        order = [(BGC, baseline), (Smooth, smooth), (Normalize, normalize)] if i == 0 else \
+            [(Normalize, normalize), (BGC, baseline), (Smooth, smooth)]
+        return [stage for switch, stage in order if switch[i].value]
+
+    # Incremental series kept between runs of Make_Mesh
+    series = {}
+
+    def extend_series(paths, paths2, stages, load, library, Hetero, roi, bin_size, reduce, timer):
+        """Feed files selected since the last run into the incremental series, restarting it if anything else changed."""
+        settings = (Hetero, library, [[stage[2] for stage in s] for s in stages], roi, bin_size, reduce)
+        state = series.get("state")
+        if state is None or state["settings"] != settings or paths[:len(state["paths"])] != state["paths"] \
+                or paths2[:len(state["paths2"])] != state["paths2"]:
+            state = series["state"] = {"settings": settings, "paths": [], "paths2": [], "cos": None}
+
+        new, new2 = paths[len(state["paths"]):], paths2[len(state["paths2"]):]
+        if Hetero:
+            # Spectra are added in pairs; a file without its partner in the other set waits for it
+            new, new2 = new[:len(new2)], new2[:len(new)]
+        if new:
+            x1, spectra1, _ = cos_engine.run_stages(("Load 1", "Combining First Spectra Set", new, load, library),
+                                                    stages[0], timer=timer)
+            x2, spectra2 = None, None
+            if Hetero:
+                x2, spectra2, _ = cos_engine.run_stages(
+                    ("Load 2", "Combining Second Spectra Set", new2, load, library), stages[1], timer=timer)
+
+            with timer.stage("Update", f"Adding {len(new)} Spectra to the Series"):
+                if state["cos"] is None:
+                    state["cos"] = cos_engine.IncrementalCOS(x1, x2, roi=roi, bin_size=bin_size, reduce=reduce)
+                state["cos"].extend(spectra1, spectra2, x1=x1, x2=x2)
+            state["paths"] = state["paths"] + new
+            state["paths2"] = state["paths2"] + new2
+
+        if state["cos"] is None:
+            raise IndexError("No spectra selected")
+        return state["cos"].to_cos()
 
     def Make_Mesh(browser=None, browser2=None, Hetero=False, status=None,
                   Normalize=[], BGC=[], Smooth=[],
-                  degree=[], smoothness=[], length=[]):
+                  degree=[], smoothness=[], length=[], engine="noda", packed=False,
+                  roi=None, bin_size=1, reduce="mean", out_of_core=False, memory_budget=None, workers=1,
+                  cache_size=None, incremental=False, resample=None, library_spectra=None):
 
+        timer = cos_engine.StageTimer(status)
+        cache = cos_engine.StageCache(max_mb=cache_size) if cache_size else None
         paths = [browser.path(i) for i in range(len(browser.value))]
-
-        dfs = []
-        for p in paths:
-            dfs.append(pd.read_csv(p, header=None))
-
-        x_values = dfs[0].iloc[:, 0]
-        y_columns = []
-        for df in dfs:
-            y_columns.append(df.iloc[:, 1])
-        status.update(title="Combining First Spectra Set")
-        combined_df = pd.concat([x_values] + y_columns, axis=1)
-        combined_df.columns = [""] + list(range(1, len(paths) + 1))
-
-        if BGC[0].value:
-            status.update(title="Applying Background Correction to the First Spectra Set")
-            combined_df = baseline_correction(df=combined_df, degree=degree[0], mode=BGC_toggle.value)
-
-        if Smooth[0].value:
-            status.update(title="Smoothing the First Spectra Set")
-            combined_df = smooth_data(df=combined_df, window_length=length[0], polyorder=smoothness[0])
-
-        if Normalize[0].value:
-            status.update(title="Normalize First Spectra Set")
-            combined_df = normalize(combined_df)
-
-        combined_df.to_csv("Combined.csv", index=False)
-
+        paths2 = [browser2.path(i) for i in range(len(browser2.value))] if Hetero else []
+        stages = [preprocessing_stages(0, Normalize, BGC, Smooth, degree, smoothness, length,
+                                       "classic" if BGC_toggle.value else "modpoly", workers),
+                  preprocessing_stages(1, Normalize, BGC, Smooth, degree, smoothness, length,
+                                       "classic" if BGC2_toggle.value else "modpoly", workers) if Hetero else []]
+
+        # Libraries only read the selected spectra and the rows inside the ROI; both are part of the load's cache key
+        library = (None if library_spectra is None else sorted(library_spectra), roi)
+
+        def read(path, header="infer"):
+            x, spectra = spectra_io.read_spectra(path, header=header, names=library[0], xlim=roi)
+            if np.isnan(spectra).any():
+                raise ValueError(f"{os.path.basename(path)} has missing points, as libraries merged from "
+                                 f"different axes do. Rebuild it with align='interpolate'.")
+            return x, spectra
+
+        # Spectra on a different axis than the first file of their set are interpolated onto it
+        def load(paths):
+            return cos_engine.load_spectra(paths, align="interpolate", workers=workers, read=read)
+
+        if incremental:
+            cos = extend_series(paths, paths2, stages, load, library, Hetero, roi, bin_size, reduce, timer)
+            cos.timings = timer.timings
+            return cos
+
+        x1, spectra1, key1 = cos_engine.run_stages(
+            ("Load 1", "Combining First Spectra Set", paths, load, library), stages[0], cache=cache, timer=timer)
+
+        x2, spectra2, key2 = None, None, None
         if Hetero:
-            paths2 = [browser2.path(i) for i in range(len(browser2.value))]
-
-            dfs2 = []
-            for p in paths2:
-                dfs2.append(pd.read_csv(p, header=None))
-
-            x_values2 = dfs2[0].iloc[:, 0]
-            y_columns2 = []
-            for df in dfs2:
-                y_columns2.append(df.iloc[:, 1])  
-            status.update(title="Combining Second Spectra Set")
-            combined_df2 = pd.concat([x_values2] + y_columns2, axis=1)
-            combined_df2.columns = [""] + list(range(1, len(paths2) + 1))
-
-            if Normalize[1].value:
-                status.update(title="Normalizing Second Spectra Set")
-                combined_df2 = normalize(combined_df2)
-
-            if BGC[1].value:
-                status.update(title="Applying Background Correction to the Second Spectra Set")
-                combined_df2 = baseline_correction(combined_df2, degree=degree[1], mode=BGC2_toggle.value)
-
-            if Smooth[1].value:
-                status.update(title="Smoothing the Second Spectra Set")
-                combined_df2 = smooth_data(combined_df2, window_length=length[1], polyorder=smoothness[1])
-
-            combined_df2.to_csv("Combined2.csv", index=False)
-
-        inputfile1 = "Combined.csv"
-        inputfile2 = "Combined2.csv" if Hetero else inputfile1
-
-        spec1 = pd.read_csv(inputfile1, header=0, index_col=0).T
-        spec2 = pd.read_csv(inputfile2, header=0, index_col=0).T
-
-        if len(spec1) != len(spec2):
-            raise Exception(f"Data mismatching: len1 = {len(spec1)}, len2 = {len(spec2)}")
-
-        spec1 -= spec1.mean()
-        spec2 -= spec2.mean()
+            x2, spectra2, key2 = cos_engine.run_stages(
+                ("Load 2", "Combining Second Spectra Set", paths2, load, library), stages[1], cache=cache,
+                timer=timer)
+
+        def build_cos():
+            # TwoDCOS resamples both sets onto the common grid before cropping and binning them
+            return cos_engine.TwoDCOS(
+                x1, spectra1, x2, spectra2,
+                engine=engine, packed=packed, roi=roi, bin_size=bin_size, reduce=reduce,
+                out_dir="__marimo__/out_of_core" if out_of_core else None, memory_budget=memory_budget,
+                workers=workers, resample=resample)
+
+        if resample is None:
+            cos = build_cos()
+        else:
+            with timer.stage("Resample", f"Resampling onto a Common Grid ({resample.title()})"):
+                cos = build_cos()
 
-        status.update(title="Generating Synchronous Correlation")
-        sync = pd.DataFrame(spec1.values.T @ spec2.values / (len(spec1) - 1))
-        sync.index = spec1.columns
-        sync.columns = spec2.columns
-        sync = sync.T
-        sync.to_csv("_sync.csv")
+        # Out-of-core maps are already on disk, so only in-memory maps go through the cache
+        maps_key = None if cache is None or out_of_core else \
+            cos_engine.StageCache.key(key1, key2, packed, roi, bin_size, reduce, resample)
 
-        status.update(title="Generating Hilbert Noda Matrix")
-        noda = np.zeros((len(spec1), len(spec1)))
-        for i in range(len(spec1)):
-            for j in range(len(spec1)):
-                if i != j:
-                    noda[i, j] = 1 / math.pi / (j - i)
+        with timer.stage("Sync", f"Generating Synchronous Correlation ({len(cos.x1)} x {len(cos.x2)} points)"):
+            if maps_key is None:
+                cos.compute_sync()
+            else:
+                cos.sync = cache.fetch_map(cos_engine.StageCache.key(maps_key, "sync"), cos.compute_sync,
+                                           cos.x1, cos.x2)
+
+        async_title = "Generating Asynchronous Correlation (Hilbert Noda Matrix)" if engine == "noda" \
+            else "Generating Asynchronous Correlation (FFT)"
+        with timer.stage("Async", async_title):
+            if maps_key is None:
+                cos.compute_async()
+            else:
+                # Both engines give the same map, so the engine is not part of the key
+                cos.asyn = cache.fetch_map(cos_engine.StageCache.key(maps_key, "async"), cos.compute_async,
+                                           cos.x1, cos.x2)
 
-        status.update(subtitle="Generating Asynchronous Correlation")
-        asyn = pd.DataFrame(spec1.values.T @ noda @ spec2.values / (len(spec1) - 1))
-        asyn.index = spec1.columns
-        asyn.columns = spec2.columns
-        asyn = asyn.T
-        asyn.to_csv("_async.csv")
+        cos.timings = timer.timings
+        return cos
 
-    def COS_Plot(Hetero=False, Input_path1=None, Input_path2=None, Correlation_path=None, 
-                 title="Untitled", colour=None, levels=3, CLines=True):
+    def COS_Plot(cos=None, asynchronous=False, Hetero=False, Input_path1=None, Input_path2=None, Correlation_path=None, 
+                 title="Untitled", colour=None, levels=3, CLines=True, detail=None, backend="contour"):
 
-        Corre_data, Input_data, spect1, spect2 = read_data(Hetero, Input_path1, Input_path2, Correlation_path)
+        if cos is not None:
+            Corre_data, Input_data, spect1, spect2 = cos.plot_data(asynchronous)
+            Hetero = cos.hetero
+        else:
+            Corre_data, Input_data, spect1, spect2 = read_data(Hetero, Input_path1, Input_path2, Correlation_path)
 
         fig = init_figure(title)
 
@@ -279,40 +293,158 @@ def _(
 
         ax_Top.plot(Input_data[0], Input_data[1], color='black', linewidth=1.5)
         ax_Top.set_xlim([Input_data[0].max(), Input_data[0].min()])
-        for i in range(1, len(spect1.columns)):
-            ax_Top.plot(spect1.iloc[:, 0], spect1.iloc[:, i], linestyle=":", alpha = 0.5)
+        ax_Top.plot(spect1[0], spect1[1], linestyle=":", alpha = 0.5)
 
 
         if Hetero:
             ax_Left.plot(Input_data[3], Input_data[2], color='black', linewidth=1.5)
             ax_Left.set_ylim([Input_data[2].min(), Input_data[2].max()])
-            for i in range(1, len(spect2.columns)):
-                ax_Left.plot(spect2.iloc[:, i], spect2.iloc[:, 0], linestyle=":",alpha = 0.5)
+            ax_Left.plot(spect2[1], spect2[0], linestyle=":",alpha = 0.5)
         else:
             ax_Left.plot(Input_data[1], Input_data[0], color='black', linewidth=1.5)
             ax_Left.set_ylim([Input_data[0].min(), Input_data[0].max()])
-            for i in range(1, len(spect1.columns)):
-                ax_Left.plot(spect1.iloc[:, i], spect1.iloc[:, 0], linestyle=":",alpha = 0.5)
+            ax_Left.plot(spect1[1], spect1[0], linestyle=":",alpha = 0.5)
 
-        mesh = ax_main.contourf(Corre_data[0], Corre_data[1], Corre_data[2], levels=levels, cmap=colour)
+        fig._ax_main = ax_main
+        fig._Corre_data = Corre_data
+        fig._contours = {}
+        fig._backend = backend
+        if detail and max(len(Corre_data[0]), len(Corre_data[1])) > detail:
+            # Large maps draw the coarsest pyramid level and refine it on zoom (refresh_detail)
+            fig._pyramid = cos_engine.MapPyramid(*Corre_data, max_points=detail)
+            fig._view_data = list(fig._pyramid.overview())
+            fig._tile = (len(fig._pyramid) - 1, None, None)
+            fig._level_values = {}
+        else:
+            fig._view_data = [Corre_data[0], Corre_data[1], np.asarray(Corre_data[2])]
+        mesh = contour_layer(fig, ax_main, "fill", levels)
+        mesh.set_cmap(colour)
         if CLines:
-            ax_main.contour(Corre_data[0], Corre_data[1], Corre_data[2], levels=levels, colors="black", linewidths=0.5)
+            contour_layer(fig, ax_main, "lines", levels)
 
         x_min, x_max = Corre_data[0].min(), Corre_data[0].max()
         y_min, y_max = Corre_data[1].min(), Corre_data[1].max()
         ax_main.plot([x_min, x_max], [y_min, y_max], linestyle="--", color="black", linewidth=0.75)
 
-        norm = colors.Normalize(vmin=-Corre_data[2].max(), vmax=Corre_data[2].max())
         cbar_ax = fig.add_axes([0.925, 0.11, 0.02, 0.545])  # [left, bottom, width, height] in figure coordinates
         cbar = fig.colorbar(mesh, cax=cbar_ax, orientation='vertical')
         fig._cbar_ax = cbar_ax 
+        fig._cbar = cbar
 
-        fig._ax_main = ax_main
-        fig._Corre_data = Corre_data
         fig._contour = mesh
+        fig._contour_style = (colour, levels, False)
+        fig._restyle = (colour, levels, CLines, False)
 
         return fig
 
+    def contour_levels(fig, levels):
+        """Contour levels to draw; with a pyramid they are fixed from the overview so every tile shares them."""
+        if not hasattr(fig, "_pyramid"):
+            return levels
+        if levels not in fig._level_values:
+            overview = fig._pyramid.overview()[2]
+            locator = ticker.MaxNLocator(levels + 1, min_n_ticks=1)
+            fig._level_values[levels] = locator.tick_values(overview.min(), overview.max())
+        return fig._level_values[levels]
+
+    def refresh_detail(fig):
+        """Redraw the map from the pyramid level and tile that match the current zoom, if it changed."""
+        pyramid = getattr(fig, "_pyramid", None)
+        if pyramid is None or getattr(fig, "_refreshing", False):
+            return
+        ax = fig._ax_main
+        level, rows, cols = pyramid.select(ax.get_xlim(), ax.get_ylim())
+        shown_level, shown_rows, shown_cols = fig._tile
+        if level == shown_level and (shown_rows is None or (
+                shown_rows.start <= rows.start and rows.stop <= shown_rows.stop
+                and shown_cols.start <= cols.start and cols.stop <= shown_cols.stop)):
+            return
+
+        fig._refreshing = True
+        try:
+            # A tile must not rescale the axes to its own extent
+            ax.set_autoscale_on(False)
+            rows, cols, fig._view_data = pyramid.tile(level, rows, cols)
+            fig._tile = (level, rows, cols)
+            replace_layers(fig)
+        finally:
+            fig._refreshing = False
+
+    def replace_layers(fig):
+        """Redraw every map layer from fig._view_data with the current style and backend."""
+        # The old layers go once the colorbar has moved to the new ones
+        shown = [layer for layer, _ in fig._contours.values()]
+        fig._contours = {}
+        fig._contour_style = None
+        restyle_contours(fig, *fig._restyle)
+        for layer in shown:
+            layer.remove()
+
+    def layer_key(fig, kind, levels):
+        """Cache key of a map layer; the raster heatmap does not depend on the number of levels."""
+        return ("raster",) if kind == "fill" and fig._backend == "raster" else (kind, levels)
+
+    def contour_layer(fig, ax, kind, levels):
+        """Filled map ("fill") or contour lines ("lines"), triangulated once per number of levels.
+
+        The raster backend draws the filled map as a rasterized heatmap; the
+        contour lines stay vector either way.
+        """
+        key = layer_key(fig, kind, levels)
+        if key not in fig._contours:
+            view = fig._view_data
+            if key == ("raster",):
+                layer = ax.pcolormesh(view[0], view[1], view[2], shading="nearest", rasterized=True)
+            elif kind == "fill":
+                layer = ax.contourf(view[0], view[1], view[2], levels=contour_levels(fig, levels))
+            else:
+                layer = ax.contour(view[0], view[1], view[2], levels=contour_levels(fig, levels), colors="black",
+                                   linewidths=0.5)
+            fig._contours[key] = (layer, layer.get_clim())
+        return fig._contours[key][0]
+
+    def restyle_contours(fig, cmap_name, levels, draw_contour_lines, centre):
+        """Show the contour sets for `levels`, hide the rest, and recolour only when the colour settings changed."""
+        fig._restyle = (cmap_name, levels, draw_contour_lines, centre)
+        ax = fig._ax_main
+        mesh = contour_layer(fig, ax, "fill", levels)
+        shown = {layer_key(fig, "fill", levels)}
+        if draw_contour_lines:
+            contour_layer(fig, ax, "lines", levels)
+            shown.add(layer_key(fig, "lines", levels))
+        for key, (layer, _) in fig._contours.items():
+            layer.set_visible(key in shown)
+
+        style = (cmap_name, levels, centre)
+        if style == getattr(fig, "_contour_style", None):
+            return
+        mesh.set_cmap(cmap_name)
+        if centre:
+            if not hasattr(fig, "_abs_max"):
+                fig._abs_max = cos_engine.abs_max(fig._Corre_data[2])
+            mesh.set_clim(-fig._abs_max, fig._abs_max)
+        else:
+            mesh.set_clim(*fig._contours[layer_key(fig, "fill", levels)][1])
+
+        attach_colorbar(fig, mesh)
+        fig._contour = mesh
+        fig._contour_style = style
+
+    def attach_colorbar(fig, mesh):
+        """Point the colorbar at `mesh`, rebuilding it in place when `mesh` is another layer.
+
+        A colorbar keeps the boundaries of the contour set it was made for, so
+        update_normal alone would leave the old levels after a level change.
+        """
+        if mesh is fig._cbar.mappable:
+            fig._cbar.update_normal(mesh)
+        else:
+            position = fig._cbar_ax.get_position()
+            fig._cbar.remove()
+            fig._cbar_ax = fig.add_axes(position)
+            fig._cbar = fig.colorbar(mesh, cax=fig._cbar_ax, orientation='vertical')
+        fig._cbar.set_label("Correlation Intensity", fontsize=12)
+
     def update_plot_style(
         fig=None,
         title=None,
@@ -321,7 +453,8 @@ def _(
         cmap_name='coolwarm',
         levels=contour_number.value,
         draw_contour_lines=True,
-        centre=False
+        centre=False,
+        backend=None
     ):
 
         ax_list = fig.get_axes()
@@ -330,6 +463,7 @@ def _(
 
         ax_Top, ax_Left, ax_main = ax_list[:3]
 
+        # Text only, the contours are left alone
         if title:
             fig.suptitle(title, fontsize=label_fontsize + 2, x=0.625, y=0.95)
 
@@ -339,33 +473,13 @@ def _(
         for ax in [ax_Top, ax_Left, ax_main]:
             ax.tick_params(axis='both', labelsize=tick_fontsize)
 
-        if hasattr(fig, "_Corre_data") and hasattr(fig, "_ax_main"):
-            Corre_data = fig._Corre_data
-            ax = fig._ax_main
-
-            for coll in ax.collections:
-                coll.remove()
-
-            if centre == True:
-                vmin = -np.max(np.abs(Corre_data[2]))
-                vmax = np.max(np.abs(Corre_data[2]))
-
-                mesh = ax.contourf(Corre_data[0], Corre_data[1], Corre_data[2],
-                                    levels=levels, cmap=cmap_name, vmin=vmin, vmax=vmax)
+        if hasattr(fig, "_contours"):
+            if backend is not None and backend != fig._backend:
+                fig._backend = backend
+                fig._restyle = (cmap_name, levels, draw_contour_lines, centre)
+                replace_layers(fig)
             else:
-                mesh = ax.contourf(Corre_data[0], Corre_data[1], Corre_data[2], levels=levels, cmap=cmap_name)
-
-            if draw_contour_lines:
-                ax.contour(Corre_data[0], Corre_data[1], Corre_data[2], levels=levels, colors="black", linewidths=0.5)
-
-            if hasattr(fig, "_cbar_ax"):
-                fig.delaxes(fig._cbar_ax)
-
-            cbar_ax = fig.add_axes(fig._cbar_ax)
-            cbar = fig.colorbar(mesh, cax=cbar_ax, orientation='vertical')
-            cbar.set_label("Correlation Intensity", fontsize=12)
-
-            fig._cbar_ax = cbar_ax
+                restyle_contours(fig, cmap_name, levels, draw_contour_lines, centre)
 
         fig.canvas.draw_idle()
 
@@ -384,13 +498,15 @@ def _(
             if var in globals():
                 del globals()[var]
 
+        cos_engine.StageCache().clear()
+        spectra_io.clear_cache()
         gc.collect()
         mo.md("✅ Cleared memory and cache.")
     return COS_Plot, Make_Mesh, clear_cache, update_plot_style
 
 
 @app.cell
-def _(mo):
+def _(mo, os):
     # Toggles
     pause = mo.ui.switch(label="Pause Execution:")
     hetero_switch = mo.ui.switch(label='Toggle Hetero Spectra:')
@@ -399,19 +515,66 @@ def _(mo):
     Smooth = mo.ui.switch(value=False, label='Smooth:')
     BGC_toggle = mo.ui.switch(label= "Switch to Classic BGC")
     BGC2_toggle = mo.ui.switch(label= "Switch to Classic BGC")
+    async_engine = mo.ui.dropdown(options={"Hilbert-Noda Matrix": "noda", "FFT": "fft"},
+                                  value="Hilbert-Noda Matrix", label="Asynchronous Engine:")
+    packed_switch = mo.ui.switch(value=False, label="Packed Symmetric Maps:")
+    roi_slider = mo.ui.range_slider(start=400, stop=4000, step=10, value=[400, 4000], full_width=True,
+                                    label="Region of Interest (cm⁻¹):")
+    bin_size = mo.ui.slider(start=1, stop=16, value=1, label="Bin Size:")
+    bin_mode = mo.ui.dropdown(options={"Average": "mean", "Decimate": "decimate"}, value="Average",
+                              label="Binning:")
+    ooc_switch = mo.ui.switch(value=False, label="Out-of-Core Maps:")
+    memory_budget = mo.ui.number(start=16, stop=4096, step=16, value=256, label="Memory Budget (MB):")
+    workers = mo.ui.slider(start=1, stop=max(2, os.cpu_count() or 1), value=1, label="Worker Threads:")
+    incremental_switch = mo.ui.switch(value=False, label="Incremental Series:")
+    cache_size = mo.ui.number(start=0, stop=16384, step=256, value=1024, label="Result Cache (MB):")
+    resample_mode = mo.ui.dropdown(options={"Off": None, "Linear": "linear", "Cubic": "cubic"},
+                                   value="Off", label="Resample to Common Grid:")
+    export_format = mo.ui.dropdown(options={"Binary (.cosmap, float64)": "float64",
+                                            "Binary (.cosmap, float32)": "float32",
+                                            "CSV": "csv"},
+                                   value="Binary (.cosmap, float64)", label="Export Format:")
     return (
         BGC,
         BGC2_toggle,
         BGC_toggle,
         Normalize,
         Smooth,
+        async_engine,
+        bin_mode,
+        bin_size,
+        cache_size,
+        export_format,
         hetero_switch,
+        incremental_switch,
+        memory_budget,
+        ooc_switch,
+        packed_switch,
         pause,
+        resample_mode,
+        roi_slider,
+        workers,
     )
 
 
 @app.cell
-def _(BGC2_toggle, BGC_toggle, mo, pd):
+def _(
+    BGC2_toggle,
+    BGC_toggle,
+    async_engine,
+    bin_mode,
+    bin_size,
+    cache_size,
+    incremental_switch,
+    memory_budget,
+    mo,
+    ooc_switch,
+    packed_switch,
+    pd,
+    resample_mode,
+    roi_slider,
+    workers,
+):
     example = pd.DataFrame({
         "": [3999.09091, 3998.37397, 3997.65703, 3996.94009, 3996.22315, 3995.50621, 3994.78927],
         " ": [1.00000, 0.99892, 0.99827, 0.99827, 0.99876, 0.99947, 0.99355]
@@ -420,7 +583,7 @@ def _(BGC2_toggle, BGC_toggle, mo, pd):
     base_text = "Apply a baseline correction to spectra improving readability and visibility of small peaks"
     Polyorder_info = "Degree of the polynomial used for the fit (Must be less than window length) If choice is too high you may lose detail, espically for small peaks"
     wlength_info = "The number of points used to fit the polynomial (Can only be an odd integer)"
-    csv_req = f"Select IR spectra to be plotted must have more than 1 .csv file with the format: (Wavenumber, Intensity) with no headers. Invalid files will cause errors."
+    csv_req = f"Select IR spectra to be plotted must have more than 1 spectrum in total. Accepted files are .csv, OPUS .dpt and RRUFF .txt exports with the format: (Wavenumber, Intensity), with or without a header row. Wide .csv files (Wavenumber, sample 1, sample 2, ...) and .parquet spectral libraries add one spectrum per column; the spectra taken from a library can be narrowed under Library Spectra, and only those and the Region of Interest are read from it. Invalid files will cause errors."
 
     correction_info = mo.accordion({
         "Info" : mo.vstack([mo.md("*Here is additional infromation for each correction:*"),
@@ -448,24 +611,53 @@ def _(BGC2_toggle, BGC_toggle, mo, pd):
 
     })
 
+    engine_info = "The FFT engine computes the asynchronous map without building the Hilbert-Noda matrix, which is faster for long perturbation series"
+    packed_info = "Only compute and keep the upper triangle of each map, halving the time and memory for large single-set runs"
+    roi_info = "Spectra are cropped to the region and every *Bin Size* points are merged before correlating, so smaller regions and larger bins make the maps much faster"
+
+    ooc_info = "Compute the maps in tiles that fit the memory budget and stream them to disk instead of holding them in RAM"
+    workers_info = "Spread the preprocessing and the correlation tiles over several cores"
+    incremental_info = "For series that grow one spectrum at a time: files added to the end of the selection update the maps instead of recomputing them (full maps, Hilbert-Noda)"
+    resample_info = "Interpolate every spectrum of both sets onto one evenly spaced grid over their shared range, so sets from different instruments correlate point for point (not used by the incremental series)"
+    cache_info = "Keep preprocessed spectra and maps in __marimo__/cache so re-running with the same files and settings is instant (0 turns it off)"
+
+    roi_controls = mo.vstack([roi_slider, mo.hstack([bin_size, bin_mode], justify="start"), mo.md(f"*{roi_info}*"),
+                              mo.hstack([resample_mode, mo.md(f"*{resample_info}*")], justify="start")])
+    ooc_controls = mo.vstack([
+        mo.hstack([ooc_switch, memory_budget, mo.md(f"*{ooc_info}*")], justify="start"),
+        mo.hstack([workers, mo.md(f"*{workers_info}*")], justify="start"),
+        mo.hstack([cache_size, mo.md(f"*{cache_info}*")], justify="start")])
+
     Advanced_mod = mo.accordion({
-        "Advanced Options" : mo.hstack([BGC_toggle], justify="start")
+        "Advanced Options" : mo.vstack([
+            mo.hstack([BGC_toggle], justify="start"),
+            mo.hstack([async_engine, mo.md(f"*{engine_info}*")], justify="start"),
+            mo.hstack([packed_switch, mo.md(f"*{packed_info}*")], justify="start"),
+            mo.hstack([incremental_switch, mo.md(f"*{incremental_info}*")], justify="start"),
+            ooc_controls,
+            roi_controls])
     })
 
     Advanced_mod2 = mo.accordion({
         "Advanced Options" : mo.vstack([
             mo.hstack([mo.md("Spectra 1:" ), BGC_toggle], justify="start"), 
-            mo.hstack([mo.md("Spectra 2:" ), BGC2_toggle], justify="start")])
+            mo.hstack([mo.md("Spectra 2:" ), BGC2_toggle], justify="start"),
+            mo.hstack([async_engine, mo.md(f"*{engine_info}*")], justify="start"),
+            mo.hstack([incremental_switch, mo.md(f"*{incremental_info}*")], justify="start"),
+            ooc_controls,
+            roi_controls])
     })
     return Advanced_mod, Advanced_mod2, browser_info, correction_info
 
 
 @app.cell
-def _(hetero_switch, mo):
-    browser = mo.ui.file_browser(initial_path="", filetypes=[".csv"], multiple=True, restrict_navigation=True)
+def _(hetero_switch, mo, spectra_io):
+    browser = mo.ui.file_browser(initial_path="", filetypes=[*spectra_io.FILETYPES, spectra_io.LIBRARY_SUFFIX], multiple=True,
+                                 restrict_navigation=True)
 
     if hetero_switch.value:
-        browser2 = mo.ui.file_browser(initial_path="", filetypes=[".csv"], multiple=True, restrict_navigation=True)
+        browser2 = mo.ui.file_browser(initial_path="", filetypes=[*spectra_io.FILETYPES, spectra_io.LIBRARY_SUFFIX], multiple=True,
+                                      restrict_navigation=True)
 
     else:
         browser2 = ""
@@ -482,6 +674,22 @@ def _(hetero_switch, mo):
     return BGC2, Normalize2, Smooth2, browser, browser2
 
 
+@app.cell
+def _(browser, browser2, hetero_switch, mo, spectra_io):
+    # Spectra of the selected libraries, all of them unless some are deselected
+    selected = [browser.path(i) for i in range(len(browser.value))]
+    if hetero_switch.value:
+        selected += [browser2.path(i) for i in range(len(browser2.value))]
+    library_names = list(dict.fromkeys(name for path in selected if str(path).endswith(spectra_io.LIBRARY_SUFFIX)
+                                       for name in spectra_io.library_names(path)))
+
+    if library_names:
+        library_spectra = mo.ui.multiselect(options=library_names, value=library_names, label="Library Spectra:")
+    else:
+        library_spectra = ""
+    return (library_spectra,)
+
+
 @app.cell
 def _(mo):
     diverging_colormaps = [
@@ -501,12 +709,18 @@ def _(mo):
     clines_switch = mo.ui.switch(value=False, label='Toggle Contour outlines:')
     asynchronous = mo.ui.switch(value=False, label='Asyncronous Plot:')
     centre = mo.ui.switch(value=True, label = 'Center Colourmap Around Zero:')
+    backend = mo.ui.dropdown(options={"Vector Contours": "contour", "Raster Heatmap": "raster"},
+                             value="Vector Contours", label="Map Rendering:")
+    detail_points = mo.ui.slider(start=250, stop=2000, step=250, value=1000,
+                                 label="Level of Detail (max points per axis)")
     return (
         asynchronous,
+        backend,
         centre,
         clines_switch,
         colormap_dropdown,
         contour_number,
+        detail_points,
         label_fontsize,
         tick_fontsize,
         title_fontsize,
@@ -577,6 +791,7 @@ def _(
     hetero_switch,
     length,
     length2,
+    library_spectra,
     mo,
     pause,
     smoothness,
@@ -600,12 +815,14 @@ def _(
                                mo.vstack([mo.md("Fist Spectra Set:"), browser, hetero_switch]), 
                                mo.vstack([mo.md("Second Spectra Set"), browser2])
                            ]),
+                           library_spectra,
                            browser_info
                        ]),
        })
 
     else:
-        browse_drop = mo.accordion({"Select Spectra:": mo.vstack([mo.md(""), browser, hetero_switch, browser_info]),
+        browse_drop = mo.accordion({"Select Spectra:": mo.vstack([mo.md(""), browser, hetero_switch, library_spectra,
+                                                                   browser_info]),
 
                                    })
 
@@ -671,43 +888,73 @@ def _(
     Make_Mesh,
     Normalizes,
     Smooths,
+    async_engine,
+    bin_mode,
+    bin_size,
     browser,
     browser2,
+    cache_size,
     degree_val,
     hetero_switch,
+    incremental_switch,
+    library_spectra,
+    memory_budget,
     mo,
+    ooc_switch,
+    packed_switch,
     pause,
+    resample_mode,
+    roi_slider,
     smooth_amt,
     wlength,
+    workers,
 ):
     unpaused = not pause.value
+    roi = None if list(roi_slider.value) == [roi_slider.start, roi_slider.stop] else roi_slider.value
+
+    cos = None
 
     if unpaused:
         try:
             with mo.status.spinner(title="Running Correlation",  subtitle=("☕ This may take a moment... Go grab a coffee! ☕")) as spinner:
-                Make_Mesh(browser=browser, browser2=browser2, Hetero=hetero_switch.value, status=spinner, Normalize=Normalizes, BGC=BGCs,
-                          Smooth=Smooths, degree=degree_val, smoothness=smooth_amt, length=wlength)
-
-            done_text = mo.md("## ✅ Mesh generation complete! ✅")
+                cos = Make_Mesh(browser=browser, browser2=browser2, Hetero=hetero_switch.value, status=spinner, Normalize=Normalizes, BGC=BGCs,
+                          Smooth=Smooths, degree=degree_val, smoothness=smooth_amt, length=wlength,
+                          engine=async_engine.value, packed=packed_switch.value,
+                          roi=roi, bin_size=bin_size.value, reduce=bin_mode.value,
+                          out_of_core=ooc_switch.value, memory_budget=memory_budget.value,
+                          workers=workers.value, cache_size=cache_size.value,
+                          incremental=incremental_switch.value, resample=resample_mode.value,
+                          library_spectra=library_spectra.value if library_spectra else None)
+
+            timing_rows = "\n".join(f"| {stage} | {seconds:.2f} |" for stage, seconds in cos.timings.items())
+            done_text = mo.vstack([
+                mo.md("## ✅ Mesh generation complete! ✅"),
+                mo.accordion({"Timings": mo.md(f"| Stage | Time (s) |\n|---|---|\n{timing_rows}")})])
             sucess = True
 
         except IndexError as e:
             done_text = mo.md(f"## ⚠️ No spectra Selected! Select Spectra to generate Plot ⚠️")
             sucess = False
+
+        except (ValueError, OSError) as e:
+            done_text = mo.md(f"## ⚠️ {e} ⚠️")
+            sucess = False
     else:
         done_text = None
 
     done_text
-    return sucess, unpaused
+    return cos, sucess, unpaused
 
 
 @app.cell
 def _(
     asynchronous,
+    backend,
     centre,
     clines_switch,
     colormap_dropdown,
     contour_number,
+    detail_points,
     fig,
     label_fontsize,
     mo,
@@ -724,13 +971,15 @@ def _(
         cmap_name=colormap_dropdown.value,
         levels=contour_number.value,
         draw_contour_lines=clines_switch.value,
-        centre=centre.value
+        centre=centre.value,
+        backend=backend.value
     ))
 
 
     mo.accordion({"Adjust Plot Output:": mo.vstack([
         title_input, colormap_dropdown, title_fontsize, label_fontsize, 
-        tick_fontsize, contour_number, mo.hstack([asynchronous, clines_switch, centre], justify="start"),
+        tick_fontsize, contour_number, backend, detail_points,
+        mo.hstack([asynchronous, clines_switch, centre], justify="start"),
         drawPlot
         ])})
 
@@ -738,37 +987,24 @@ def _(
 
 
 @app.cell
-def _(clear_cache, mo):
+def _(clear_cache, cos, export_format, mo):
     clear_button = mo.ui.button(label="Clear Cache", on_click=lambda _: clear_cache())
+    export_button = mo.ui.button(label="Export", disabled=cos is None,
+                                 on_click=lambda _: cos.export_csv() if export_format.value == "csv"
+                                 else cos.save(dtype=export_format.value))
 
 
-    mo.hstack([clear_button], justify="start")
+    mo.hstack([clear_button, export_format, export_button], justify="start")
     return
 
 
 @app.cell
-def _(COS_Plot, asynchronous, browser, hetero_switch, mo, sucess, unpaused):
-    if asynchronous.value == False:
-        path1 = '_sync.csv'
-        path2 = 'Combined.csv'
-        path3 = 'Combined2.csv'
-
-
-    elif asynchronous.value == True:
-        path1 = '_async.csv'
-        path2 = 'Combined.csv'
-        path3 = 'Combined2.csv'
-
-
-    elif len(browser.value) != 0:
-        path1 = None
-        path2 = None
-        path3 = None
-
+def _(COS_Plot, asynchronous, backend, cos, detail_points, mo, sucess, unpaused):
     if unpaused:
         if sucess:
-            fig = COS_Plot(Hetero=hetero_switch.value, title='Your Correlation Plot', Input_path1=path2, 
-                            Input_path2=path3 ,Correlation_path=path1, levels=3,  colour="bwr", CLines=False)
+            fig = COS_Plot(cos=cos, asynchronous=asynchronous.value, title='Your Correlation Plot',
+                           levels=3,  colour="bwr", CLines=False, detail=detail_points.value,
+                           backend=backend.value)
             out = mo.mpl.interactive(fig)
             text = ""
         else:
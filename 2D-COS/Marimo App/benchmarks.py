@@ -0,0 +1,226 @@
+"""Timing benchmarks for the 2D correlation engine.
+
+Run from this folder with:
+
+    python benchmarks.py            # every benchmark
+    python benchmarks.py noda       # only the selected ones
+"""
+import argparse
+import math
+import timeit
+
+import numpy as np
+
+import cos_engine
+
+
+def best_of(func, repeat=3):
+    """Best wall time (s) of `repeat` single calls."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def hilbert_noda_loop(m):
+    """Element by element Hilbert-Noda matrix, as Make_Mesh used to build it."""
+    noda = np.zeros((m, m))
+    for i in range(m):
+        for j in range(m):
+            if i != j:
+                noda[i, j] = 1 / math.pi / (j - i)
+    return noda
+
+
+def bench_noda(sizes=(10, 50, 100, 250, 500, 1000, 2000)):
+    """Vectorized Hilbert-Noda builder against the nested loop."""
+    print(f"{'m':>6} {'loop (s)':>12} {'vectorized (s)':>16} {'speed-up':>10}")
+    for m in sizes:
+        if not np.array_equal(hilbert_noda_loop(m), cos_engine.hilbert_noda(m)):
+            raise AssertionError(f"Hilbert-Noda mismatch for m = {m}")
+
+        t_loop = best_of(lambda: hilbert_noda_loop(m), repeat=1 if m > 500 else 3)
+
+        def build():
+            cos_engine._hilbert_noda.cache_clear()
+            cos_engine.hilbert_noda(m)
+
+        t_vec = best_of(build)
+        print(f"{m:>6} {t_loop:>12.5f} {t_vec:>16.5f} {t_loop / t_vec:>9.1f}x")
+
+
+def bench_async(sizes=(10, 50, 100, 250, 500, 1000, 2000), n=1000):
+    """Asynchronous map through the dense Hilbert-Noda product against the FFT engine."""
+    rng = np.random.default_rng(0)
+    print(f"{'m':>6} {'n':>6} {'noda (s)':>12} {'fft (s)':>12} {'speed-up':>10} {'max |diff|':>12}")
+    for m in sizes:
+        spec = rng.random((m, n))
+        spec -= spec.mean(axis=0)
+
+        dense = cos_engine.asynchronous_correlation(spec, spec, engine="noda")
+        fast = cos_engine.asynchronous_correlation(spec, spec, engine="fft")
+        error = np.abs(dense - fast).max()
+        if not np.allclose(dense, fast, rtol=1e-9, atol=1e-12 * np.abs(dense).max()):
+            raise AssertionError(f"FFT engine disagrees with the Hilbert-Noda product for m = {m}: {error:.3e}")
+
+        def run_noda():
+            cos_engine._hilbert_noda.cache_clear()
+            cos_engine.asynchronous_correlation(spec, spec, engine="noda")
+
+        def run_fft():
+            cos_engine._noda_kernel_fft.cache_clear()
+            cos_engine.asynchronous_correlation(spec, spec, engine="fft")
+
+        t_noda, t_fft = best_of(run_noda), best_of(run_fft)
+        print(f"{m:>6} {n:>6} {t_noda:>12.5f} {t_fft:>12.5f} {t_noda / t_fft:>9.1f}x {error:>12.2e}")
+
+
+def bench_packed(sizes=(500, 1000, 2000, 4000), m=50):
+    """Full homo correlation against the packed upper-triangle mode."""
+    rng = np.random.default_rng(0)
+    print(f"{'n':>6} {'m':>4} {'full (s)':>10} {'packed (s)':>11} {'speed-up':>10} {'full (MB)':>10} {'packed (MB)':>12}")
+    for n in sizes:
+        spectra = rng.random((n, m))
+        x = np.arange(n)
+
+        full = cos_engine.TwoDCOS(x, spectra).compute()
+        packed = cos_engine.TwoDCOS(x, spectra, packed=True).compute()
+        for asynchronous in (False, True):
+            if not np.allclose(full.correlation(asynchronous)[2], packed.correlation(asynchronous)[2]):
+                raise AssertionError(f"Packed map differs from the full map for n = {n}")
+
+        t_full = best_of(lambda: cos_engine.TwoDCOS(x, spectra).compute())
+        t_packed = best_of(lambda: cos_engine.TwoDCOS(x, spectra, packed=True).compute())
+        mb_full = (full.sync.nbytes + full.asyn.nbytes) / 1e6
+        mb_packed = (packed.sync.packed.nbytes + packed.asyn.packed.nbytes) / 1e6
+        print(f"{n:>6} {m:>4} {t_full:>10.4f} {t_packed:>11.4f} {t_full / t_packed:>9.1f}x {mb_full:>10.1f} {mb_packed:>12.1f}")
+
+
+def bench_baseline(counts=(100, 250), n=3734, degree=3):
+    """Per-column baseline loop (np.polyfit / pybaselines modpoly) against the batched engine."""
+    from pybaselines import polynomial
+
+    rng = np.random.default_rng(0)
+    x = np.linspace(4000, 400, n)
+    print(f"{'mode':>8} {'spectra':>8} {'loop (s)':>10} {'batched (s)':>12} {'speed-up':>10} {'max |diff|':>12}")
+    for m in counts:
+        # Smooth background plus a few bands and noise, roughly like an ATR spectrum
+        background = np.polynomial.polynomial.polyval((x - 2200) / 1800, rng.normal(size=(m, degree + 1)).T).T
+        bands = sum(rng.random((1, m)) * np.exp(-((x[:, None] - c) / 15) ** 2) for c in (1795, 1410, 875))
+        spectra = background + bands + rng.normal(scale=1e-3, size=(n, m))
+
+        loops = {
+            "classic": lambda: np.column_stack([np.polyval(np.polyfit(x, y, degree), x) for y in spectra.T]),
+            "modpoly": lambda: np.column_stack([polynomial.modpoly(y, poly_order=degree)[0] for y in spectra.T]),
+        }
+        for mode, loop in loops.items():
+            error = np.abs(loop() - cos_engine.batch_baseline(x, spectra, degree, mode)).max()
+            t_loop = best_of(loop)
+            t_batch = best_of(lambda: cos_engine.batch_baseline(x, spectra, degree, mode))
+            print(f"{mode:>8} {m:>8} {t_loop:>10.4f} {t_batch:>12.4f} {t_loop / t_batch:>9.1f}x {error:>12.2e}")
+
+
+def bench_smooth(counts=(10, 100, 1000), n=3734, window_length=5, polyorder=2):
+    """Per-column Savitzky-Golay on a DataFrame copy against one in-place savgol_filter(axis=0) call."""
+    import pandas as pd
+    from scipy.signal import savgol_filter
+
+    rng = np.random.default_rng(0)
+    print(f"{'spectra':>8} {'loop (us/spectrum)':>19} {'batched (us/spectrum)':>22} {'speed-up':>10}")
+    for m in counts:
+        df = pd.DataFrame(rng.random((n, m + 1)))
+
+        def loop():
+            smoothed = df.copy()
+            for col in smoothed.columns[1:]:
+                smoothed[col] = savgol_filter(smoothed[col], window_length=window_length, polyorder=polyorder)
+            return smoothed
+
+        spectra = df.iloc[:, 1:].to_numpy(copy=True)
+        batched = cos_engine.smooth_spectra(spectra.copy(), window_length, polyorder)
+        if not np.allclose(loop().iloc[:, 1:].to_numpy(), batched):
+            raise AssertionError(f"Batched smoothing disagrees with the column loop for m = {m}")
+
+        t_loop = best_of(loop)
+        t_batch = best_of(lambda: cos_engine.smooth_spectra(spectra, window_length, polyorder))
+        print(f"{m:>8} {t_loop / m * 1e6:>19.1f} {t_batch / m * 1e6:>22.1f} {t_loop / t_batch:>9.1f}x")
+
+
+def bench_resample(counts=(10, 100, 1000), n=5022, n_ref=3734):
+    """Per-column np.interp / CubicSpline onto the common grid against one batched resample_spectra call."""
+    from scipy.interpolate import CubicSpline
+
+    rng = np.random.default_rng(0)
+    # ATR axis (about 0.72 cm-1 steps, descending) onto the grid shared with a coarser reference set
+    x = np.linspace(4000, 400, n)
+    grid = cos_engine.common_grid([x, np.linspace(150, 1400, n_ref // 3)])
+    print(f"{'kind':>7} {'spectra':>8} {'loop (s)':>10} {'batched (s)':>12} {'speed-up':>10} {'max |diff|':>12}")
+    for m in counts:
+        spectra = np.sin(np.outer(x / 90, np.ones(m)) + rng.random(m)) + rng.normal(scale=1e-3, size=(n, m))
+        loops = {
+            "linear": lambda: np.column_stack([np.interp(grid, x[::-1], y[::-1]) for y in spectra.T]),
+            "cubic": lambda: np.column_stack([CubicSpline(x[::-1], y[::-1], bc_type="natural")(grid)
+                                              for y in spectra.T]),
+        }
+        for kind, loop in loops.items():
+            error = np.abs(loop() - cos_engine.resample_spectra(x, spectra, grid, kind)).max()
+            t_loop = best_of(loop)
+            t_batch = best_of(lambda: cos_engine.resample_spectra(x, spectra, grid, kind))
+            print(f"{kind:>7} {m:>8} {t_loop:>10.4f} {t_batch:>12.4f} {t_loop / t_batch:>9.1f}x {error:>12.2e}")
+
+
+def bench_render(sizes=(250, 500, 1000, 2000), m=12, levels=8):
+    """Vector contourf map against a rasterized heatmap with vector contour lines, saved as PDF and SVG."""
+    import io
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    rng = np.random.default_rng(0)
+    print(f"{'n':>6} {'backend':>8} {'format':>7} {'time (s)':>10} {'size (MB)':>10}")
+    for n in sizes:
+        x = np.linspace(4000, 400, n)
+        spectra = np.sin(np.outer(x / 150, np.ones(m)) + np.arange(m) / 3) + rng.normal(scale=0.05, size=(n, m))
+        cos = cos_engine.TwoDCOS(x, spectra).compute()
+        x1, x2, data = cos.correlation(asynchronous=True)
+
+        def draw(backend, fmt):
+            fig, ax = plt.subplots(figsize=(8, 8))
+            if backend == "raster":
+                ax.pcolormesh(x1, x2, data, shading="nearest", cmap="bwr", rasterized=True)
+            else:
+                ax.contourf(x1, x2, data, levels=levels, cmap="bwr")
+            ax.contour(x1, x2, data, levels=levels, colors="black", linewidths=0.5)
+            ax.plot([x1.min(), x1.max()], [x2.min(), x2.max()], linestyle="--", color="black", linewidth=0.75)
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format=fmt)
+            plt.close(fig)
+            return buffer.getbuffer().nbytes
+
+        for backend in ("contour", "raster"):
+            for fmt in ("pdf", "svg"):
+                size = draw(backend, fmt)
+                t = best_of(lambda: draw(backend, fmt), repeat=1 if n > 1000 else 3)
+                print(f"{n:>6} {backend:>8} {fmt:>7} {t:>10.3f} {size / 1e6:>10.2f}")
+
+
+BENCHMARKS = {
+    "noda": bench_noda,
+    "async": bench_async,
+    "packed": bench_packed,
+    "baseline": bench_baseline,
+    "smooth": bench_smooth,
+    "resample": bench_resample,
+    "render": bench_render,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run, any of {', '.join(BENCHMARKS)} (default: all)")
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+
+    for name in args.names or BENCHMARKS:
+        print(f"\n== {name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name]()
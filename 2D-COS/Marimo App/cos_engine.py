@@ -0,0 +1,1155 @@
+"""Numerical core of the 2D correlation plotter.
+
+Everything in here is plain NumPy so it can be imported by the marimo app
+(`CorrelationPlotter.py`) as well as by `benchmarks.py`. pandas is only used
+to write CSV exports.
+"""
+import glob
+import hashlib
+import json
+import math
+import os
+import struct
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy import fft
+from scipy.interpolate import CubicSpline
+from scipy.signal import savgol_filter
+
+import spectra_io
+
+ASYNC_ENGINES = ("noda", "fft")
+REDUCE_MODES = ("mean", "decimate")
+BASELINE_MODES = ("modpoly", "classic")
+ALIGN_MODES = ("merge", "interpolate")
+RESAMPLE_MODES = ("linear", "cubic")
+STRIP_ROWS = 128
+
+MAP_SUFFIX = ".cosmap"
+CACHE_DIR = os.path.join("__marimo__", "cache")
+_MAP_MAGIC = b"COSMAP01"
+_MAP_ALIGN = 64
+
+
+@lru_cache(maxsize=8)
+def _hilbert_noda(m):
+    idx = np.arange(m)
+    diff = idx[None, :] - idx[:, None]
+    noda = np.divide(1 / math.pi, diff, out=np.zeros((m, m)), where=diff != 0)
+    noda.flags.writeable = False
+    return noda
+
+
+def hilbert_noda(m):
+    """Return the m x m Hilbert-Noda matrix, N[i, j] = 1 / (pi * (j - i)) and 0 on the diagonal.
+
+    The matrix is built in one pass from index arrays and cached by size, so
+    re-running a correlation with the same number of spectra reuses it. The
+    returned array is read-only; copy it before modifying.
+    """
+    return _hilbert_noda(int(m))
+
+
+@lru_cache(maxsize=8)
+def _noda_kernel_fft(m, nfft):
+    offsets = np.arange(-(m - 1), m)
+    kernel = np.divide(-1 / math.pi, offsets, out=np.zeros(2 * m - 1), where=offsets != 0)
+    return fft.rfft(kernel, nfft)
+
+
+def noda_transform(spec):
+    """Orthogonal spectra, hilbert_noda(m) @ spec, computed with an FFT along the perturbation axis.
+
+    `spec` is an (m x n) array with one row per spectrum. The Hilbert-Noda
+    matrix is Toeplitz, so the product is a convolution with the kernel
+    -1 / (pi * k). The FFT is padded to at least 2m - 1 points, which keeps
+    the m wanted outputs free of wrap-around, so the result matches the
+    dense product rather than the periodic FFT Hilbert transform.
+    """
+    rows = np.asarray(spec, dtype=float).T
+    m = rows.shape[-1]
+    nfft = fft.next_fast_len(2 * m - 1, real=True)
+    conv = fft.irfft(fft.rfft(rows, nfft) * _noda_kernel_fft(m, nfft), nfft)
+    return conv[:, m - 1:2 * m - 1].T
+
+
+def orthogonal_spectra(spec, engine="noda"):
+    """hilbert_noda(m) @ spec for an (m x n) spectra set, through the dense matrix or the FFT."""
+    if engine == "noda":
+        return hilbert_noda(len(spec)) @ spec
+    if engine == "fft":
+        return noda_transform(spec)
+    raise ValueError(f"Unknown asynchronous engine {engine!r}, expected one of {ASYNC_ENGINES}")
+
+
+def asynchronous_correlation(spec1, spec2, engine="noda"):
+    """Asynchronous correlation of two mean-centred (m x n) spectra sets.
+
+    engine="noda" multiplies through the dense Hilbert-Noda matrix,
+    engine="fft" transforms `spec2` with `noda_transform`; either way the
+    map itself is a single (n x m) @ (m x n) product.
+    """
+    return spec1.T @ orthogonal_spectra(spec2, engine) / (len(spec1) - 1)
+
+
+def parallel_map(func, items, workers=1):
+    """list(map(func, items)), spread over a thread pool when workers > 1.
+
+    NumPy, BLAS and SciPy release the GIL in their kernels, so threads are
+    enough to keep several cores busy without pickling the spectra.
+    """
+    if workers <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
+
+
+def imap(func, items, workers=1):
+    """Like `parallel_map`, but yields results in order as soon as they are ready."""
+    if workers <= 1:
+        yield from map(func, items)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(func, items)
+
+
+def map_columns(func, spectra, workers=1):
+    """Apply a per-spectrum function to every column of an (n x m) array, in parallel."""
+    columns = parallel_map(func, list(np.asarray(spectra).T), workers)
+    return np.column_stack(columns) if columns else np.asarray(spectra)
+
+
+class StageTimer:
+    """Wall time per pipeline stage, reported through a marimo status spinner when one is given."""
+
+    def __init__(self, status=None):
+        self.status = status
+        self.timings = {}
+
+    def summary(self):
+        return " · ".join(f"{name} {seconds:.2f} s" for name, seconds in self.timings.items())
+
+    @contextmanager
+    def stage(self, name, title=None):
+        if self.status is not None:
+            self.status.update(title=title or name, subtitle=self.summary() or None)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+            if self.status is not None:
+                self.status.update(subtitle=self.summary())
+
+
+def block_rows(n_cols, memory_budget=None, itemsize=8):
+    """Rows per tile so that one (rows x n_cols) tile fits in `memory_budget` MB; None means no limit."""
+    if memory_budget is None:
+        return None
+    return max(1, int(memory_budget * 1e6) // (n_cols * itemsize))
+
+
+def tiled_product(a, b, scale=1.0, block=None, out=None, workers=1):
+    """scale * (a @ b), computed `block` rows at a time straight into `out` (which may be a memmap).
+
+    With workers > 1 the row tiles are computed concurrently; without a block
+    size the rows are split into a few tiles per worker.
+    """
+    n = a.shape[0]
+    if out is None:
+        out = np.empty((n, b.shape[1]), dtype=np.result_type(a, b))
+    block = block or -(-n // (4 * workers if workers > 1 else 1))
+
+    def run(r0):
+        tile = out[r0:r0 + block]
+        np.matmul(a[r0:r0 + block], b, out=tile)
+        tile *= scale
+
+    parallel_map(run, range(0, n, block), workers)
+    return out
+
+
+class PackedTriangle:
+    """Upper triangle of a symmetric (sign=1) or antisymmetric (sign=-1) n x n matrix, packed row by row.
+
+    The antisymmetric diagonal is zero and is not stored. `packed` may be a
+    plain array or a memmap; `full()` (or np.asarray) rebuilds the square
+    matrix, `rows()` and slicing rebuild only the rows asked for.
+    """
+
+    def __init__(self, packed, n, sign=1):
+        self.n = int(n)
+        self.sign = sign
+        self.k = 0 if sign == 1 else 1
+        self.packed = packed
+
+    @staticmethod
+    def size(n, sign=1):
+        k = 0 if sign == 1 else 1
+        return n * (n + 1) // 2 if k == 0 else n * (n - 1) // 2
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    @property
+    def dtype(self):
+        return self.packed.dtype
+
+    def _offset(self, i):
+        return i * (self.n - self.k) - i * (i - 1) // 2
+
+    def row(self, i):
+        """Stored part of row i, columns i + k ... n - 1."""
+        start = self._offset(i)
+        return self.packed[start:start + self.n - self.k - i]
+
+    @classmethod
+    def from_product(cls, a, b, sign=1, scale=1.0, block=None, out=None, workers=1):
+        """Pack the upper triangle of scale * (a @ b), computing only the part on and right of the diagonal.
+
+        `a` is (n x m) and `b` is (m x n); the caller guarantees the product
+        is symmetric or antisymmetric. `out` can be a preallocated (memmap)
+        buffer of `size(n, sign)` elements. Row blocks fill disjoint parts of
+        the buffer, so with workers > 1 they are computed concurrently.
+
+        Each block is computed in strips of at most STRIP_ROWS rows that start
+        at their own diagonal, so only a thin sliver below the diagonal is
+        wasted and the strip is still in cache when it is packed. Storing half
+        the map is the reliable saving; the products are memory-bound for
+        short series, so on one core TwoDCOS.compute() only gets 1.1x (n = 500)
+        to 1.5x (n = 4000) faster at m = 50, and 1.1-1.2x at m = 500 where the
+        unpacked orthogonal spectra take a larger share
+        (`python benchmarks.py packed`).
+        """
+        n = a.shape[0]
+        tri = cls(out if out is not None else np.empty(cls.size(n, sign), dtype=np.result_type(a, b)), n, sign)
+        block = block or 512
+        strip = min(block, STRIP_ROWS)
+
+        def run(r0):
+            r1 = min(r0 + block, n)
+            buffer = np.empty((min(strip, r1 - r0), n - r0), dtype=tri.dtype)
+            for s0 in range(r0, r1, strip):
+                s1 = min(s0 + strip, r1)
+                tile = buffer[:s1 - s0, :n - s0]
+                np.matmul(a[s0:s1], b[:, s0:], out=tile)
+                tile *= scale
+                for i in range(s0, min(s1, n - tri.k)):
+                    tri.row(i)[:] = tile[i - s0, i - s0 + tri.k:]
+
+        parallel_map(run, range(0, n, block), workers)
+        return tri
+
+    def full(self, dtype=None):
+        out = np.zeros(self.shape, dtype=dtype or self.dtype)
+        for i in range(self.n - self.k):
+            seg = self.row(i)
+            out[i, i + self.k:] = seg
+            out[i + self.k:, i] = self.sign * seg
+        return out
+
+    def rows(self, r0, r1, dtype=None):
+        """Rows r0 ... r1 - 1 of the square matrix, reading only the parts of the triangle they need."""
+        out = np.zeros((r1 - r0, self.n), dtype=dtype or self.dtype)
+        for i in range(r0, min(r1, self.n - self.k)):
+            out[i - r0, i + self.k:] = self.row(i)
+        # Left of the diagonal, column j mirrors the stored part of row j; gathered row-wise, then transposed
+        mirror = np.zeros((r1, r1 - r0), dtype=out.dtype)
+        for j in range(r1 - 1):
+            c0 = max(r0, j + 1)
+            mirror[j, c0 - r0:] = self.row(j)[c0 - j - self.k:r1 - j - self.k]
+        mirror *= self.sign
+        out[:, :r1] += mirror.T
+        return out
+
+    def __getitem__(self, key):
+        rows, cols = key
+        r0, r1, _ = rows.indices(self.n)
+        return self.rows(r0, r1)[:, cols]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.full(dtype)
+
+
+def _poly_basis(x, degree):
+    """Vandermonde matrix of x mapped onto [-1, 1], which keeps high orders well conditioned."""
+    x = np.asarray(x, dtype=float)
+    span = x.max() - x.min()
+    mapped = 2 * (x - x.min()) / span - 1 if span else np.zeros_like(x)
+    return np.polynomial.polynomial.polyvander(mapped, degree)
+
+
+def batch_baseline(x, spectra, degree=2, mode="modpoly", tol=1e-3, max_iter=250):
+    """Polynomial baselines for every column of an (n x m) spectra array at once.
+
+    All spectra share `x`, so the Vandermonde matrix is factorised once.
+    mode="classic" is a plain least-squares fit (np.polyfit per column),
+    solved for all columns as one projection onto the polynomial basis.
+    mode="modpoly" is the modified polynomial fit of pybaselines'
+    `polynomial.modpoly` with its default settings: every iteration clips the
+    spectra to the current baseline and refits, and a column stops once the
+    relative change of its baseline drops below `tol`.
+    """
+    spectra = np.asarray(spectra, dtype=float)
+    vander = _poly_basis(x, degree)
+    if mode == "classic":
+        q, _ = np.linalg.qr(vander)
+        return q @ (q.T @ spectra)
+    if mode != "modpoly":
+        raise ValueError(f"Unknown baseline mode {mode!r}, expected one of {BASELINE_MODES}")
+
+    pinv = np.linalg.pinv(vander)
+    result = np.empty_like(spectra)
+    active = np.arange(spectra.shape[1])
+    clipped = spectra.copy()
+    baseline = vander @ (pinv @ clipped)
+    for _ in range(max_iter):
+        np.minimum(clipped, baseline, out=clipped)
+        new = vander @ (pinv @ clipped)
+        change = np.linalg.norm(new - baseline, axis=0) / np.maximum(np.linalg.norm(baseline, axis=0),
+                                                                      np.finfo(float).eps)
+        baseline = new
+        done = change < tol
+        if done.any():
+            # Only compact the working arrays when columns converge
+            result[:, active[done]] = baseline[:, done]
+            active, clipped, baseline = active[~done], clipped[:, ~done], baseline[:, ~done]
+            if active.size == 0:
+                return result
+    result[:, active] = baseline
+    return result
+
+
+def _column_chunks(m, workers=1):
+    """Split m columns into one contiguous slice per worker."""
+    bounds = np.linspace(0, m, max(1, min(workers, m)) + 1).astype(int)
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def baseline_correct(x, spectra, degree=2, mode="modpoly", workers=1):
+    """Subtract `batch_baseline` from a float (n x m) spectra array in place, splitting the columns over `workers`."""
+
+    def run(cols):
+        spectra[:, cols] -= batch_baseline(x, spectra[:, cols], degree, mode)
+
+    parallel_map(run, _column_chunks(spectra.shape[1], workers), workers)
+    return spectra
+
+
+def smooth_spectra(spectra, window_length=5, polyorder=2, workers=1):
+    """Savitzky-Golay filter every column of a float (n x m) spectra array in place.
+
+    savgol_filter runs once along the wavenumber axis for the whole array
+    (once per worker chunk with workers > 1).
+    """
+
+    def run(cols):
+        spectra[:, cols] = savgol_filter(spectra[:, cols], window_length=window_length, polyorder=polyorder, axis=0)
+
+    parallel_map(run, _column_chunks(spectra.shape[1], workers), workers)
+    return spectra
+
+
+def normalize_spectra(spectra):
+    """Min-max normalise every column of a float (n x m) spectra array in place."""
+    spectra -= spectra.min(axis=0)
+    spectra /= spectra.max(axis=0)
+    return spectra
+
+
+def _same_axis(x, other):
+    # Length and end points first, so mismatching axes rarely need the full comparison
+    return len(x) == len(other) and x[0] == other[0] and x[-1] == other[-1] and np.array_equal(x, other)
+
+
+def load_spectra(paths, header="infer", align="merge", workers=1, read=spectra_io.read_spectra):
+    """Load spectrum files into one x axis and an (n x m) array, one spectrum per column in file order.
+
+    `read(path, header=header)` returns a file's axis and its spectra, one
+    per column (spectra_io.read_spectra by default, which also takes wide
+    multi-spectrum CSVs). Files are parsed on `workers` threads and consumed
+    as they arrive. As long as every x axis matches the first file's, the
+    intensities go straight into a preallocated array. Otherwise the set is aligned once at
+    the end: align="merge" takes the sorted union of all axes (in the first
+    file's direction) with NaN where a file has no point, like an outer
+    pd.merge; align="interpolate" resamples every spectrum linearly onto the
+    first file's axis, holding the end values outside a file's range.
+    """
+    if align not in ALIGN_MODES:
+        raise ValueError(f"Unknown align mode {align!r}, expected one of {ALIGN_MODES}")
+    paths = list(paths)
+    if not paths:
+        raise IndexError("No spectra selected")
+
+    parsed = imap(lambda path: read(path, header=header), paths, workers)
+    x, spectra, filled, odd = None, None, 0, None
+    for xj, yj in parsed:
+        yj = np.asarray(yj).reshape(len(xj), -1)
+        if x is None:
+            # Sized for files alike the first one, grown if a later file holds more spectra
+            x, spectra = xj, np.empty((len(xj), len(paths) * yj.shape[1]))
+        if odd is None and _same_axis(x, xj):
+            end = filled + yj.shape[1]
+            if end > spectra.shape[1]:
+                spectra = np.concatenate([spectra[:, :filled], np.empty((len(x), end))], axis=1)
+            spectra[:, filled:end] = yj
+            filled = end
+            continue
+        if odd is None:
+            odd = [(x, spectra[:, k]) for k in range(filled)]
+        odd.extend((xj, y) for y in yj.T)
+    if odd is None:
+        return x, spectra[:, :filled]
+
+    if align == "interpolate":
+        aligned = np.empty((len(x), len(odd)))
+        for j, (xj, yj) in enumerate(odd):
+            order = np.argsort(xj)
+            aligned[:, j] = np.interp(x, xj[order], yj[order])
+        return x, aligned
+
+    union = np.unique(np.concatenate([xj for xj, _ in odd]))
+    merged = np.full((len(union), len(odd)), np.nan)
+    for j, (xj, yj) in enumerate(odd):
+        merged[np.searchsorted(union, xj), j] = yj
+    if x[0] > x[-1]:
+        union, merged = union[::-1], merged[::-1]
+    return union, merged
+
+
+def common_grid(axes, step=None):
+    """Evenly spaced grid over the wavenumber range shared by every axis in `axes`.
+
+    The spacing defaults to the coarsest median step of the axes, so no set
+    is sampled finer than it was measured. The grid runs in the direction of
+    the first axis.
+    """
+    axes = [np.asarray(x, dtype=float) for x in axes]
+    low, high = max(x.min() for x in axes), min(x.max() for x in axes)
+    if low >= high:
+        raise ValueError("The spectra sets have no wavenumber range in common")
+    step = step or max(np.median(np.abs(np.diff(x))) for x in axes)
+    grid = np.linspace(low, high, int(round((high - low) / step)) + 1)
+    return grid if axes[0][0] <= axes[0][-1] else grid[::-1]
+
+
+def resample_spectra(x, spectra, grid, kind="linear"):
+    """Resample every column of an (n x m) spectra array from `x` onto `grid` in one batched step.
+
+    kind="linear" interpolates between the two neighbouring points (the
+    indices and weights are shared by every spectrum); kind="cubic" fits one
+    natural cubic spline through all columns at once. `x` may run in either
+    direction; points of `grid` outside it take the end values.
+    """
+    x = np.asarray(x, dtype=float)
+    grid = np.clip(np.asarray(grid, dtype=float), x.min(), x.max())
+    spectra = np.asarray(spectra, dtype=float)
+    if x[0] > x[-1]:
+        x, spectra = x[::-1], spectra[::-1]
+
+    if kind == "linear":
+        right = np.clip(np.searchsorted(x, grid), 1, len(x) - 1)
+        left = right - 1
+        weight = ((grid - x[left]) / (x[right] - x[left]))[:, None]
+        return spectra[left] * (1 - weight) + spectra[right] * weight
+    if kind == "cubic":
+        return CubicSpline(x, spectra, axis=0, bc_type="natural")(grid)
+    raise ValueError(f"Unknown resampling {kind!r}, expected one of {RESAMPLE_MODES}")
+
+
+def crop_and_bin(x, spectra, roi=None, bin_size=1, reduce="mean"):
+    """Restrict (n x m) spectra to a wavenumber window and reduce the point density.
+
+    roi=(low, high) keeps the rows whose wavenumber lies inside the window,
+    in either axis direction. Every `bin_size` consecutive points are then
+    averaged (reduce="mean") or only the first one kept (reduce="decimate");
+    a trailing partial bin is dropped. Returns the new x and spectra.
+    """
+    x = np.asarray(x, dtype=float)
+    spectra = np.asarray(spectra, dtype=float)
+    if roi is not None:
+        low, high = sorted(roi)
+        keep = (x >= low) & (x <= high)
+        x, spectra = x[keep], spectra[keep]
+
+    bin_size = int(bin_size)
+    if bin_size > 1:
+        n = len(x) // bin_size * bin_size
+        if reduce == "mean":
+            x = x[:n].reshape(-1, bin_size).mean(axis=1)
+            spectra = spectra[:n].reshape(-1, bin_size, spectra.shape[1]).mean(axis=1)
+        elif reduce == "decimate":
+            x, spectra = x[:n:bin_size], spectra[:n:bin_size]
+        else:
+            raise ValueError(f"Unknown reduce mode {reduce!r}, expected one of {REDUCE_MODES}")
+
+    if len(x) == 0:
+        raise ValueError(f"No wavenumbers left inside the region of interest {roi}")
+    return x, spectra
+
+
+def map_rows(data, r0, r1):
+    """Rows r0 ... r1 - 1 of a plain, memmapped or packed map as an in-memory array."""
+    return data.rows(r0, r1) if isinstance(data, PackedTriangle) else np.asarray(data[r0:r1])
+
+
+def abs_max(data, memory_budget=16):
+    """Largest magnitude in a map, read at most `memory_budget` MB at a time."""
+    if isinstance(data, PackedTriangle):
+        # The triangle holds every value of the square matrix up to its sign
+        flat = data.packed
+        step = max(1, int(memory_budget * 1e6) // flat.itemsize)
+        return max((float(np.abs(flat[c:c + step]).max()) for c in range(0, len(flat), step)), default=0.0)
+    block = block_rows(data.shape[1], memory_budget, data.itemsize)
+    return max((float(np.abs(map_rows(data, r, r + block)).max()) for r in range(0, data.shape[0], block)),
+               default=0.0)
+
+
+def pool_extremes(x, y, data, factor=2, memory_budget=16):
+    """Downsample a (len(y) x len(x)) map by `factor` along both axes without flattening its peaks.
+
+    Every block keeps its maximum or its minimum, whichever is larger in
+    magnitude, so positive and negative cross peaks both survive; the axes
+    are averaged over the block. A trailing partial block is kept. `data` may
+    be a memmap or a `PackedTriangle`; it is read in row strips of at most
+    `memory_budget` MB, so only the pooled map is held in memory.
+    """
+    rows, cols = np.arange(0, len(y), factor), np.arange(0, len(x), factor)
+    pooled = np.empty((len(rows), len(cols)), dtype=data.dtype)
+    strip = factor * max(1, block_rows(len(x), memory_budget, data.dtype.itemsize) // factor)
+    for r0 in range(0, len(y), strip):
+        block = map_rows(data, r0, min(r0 + strip, len(y)))
+        starts = np.arange(0, len(block), factor)
+        hi = np.maximum.reduceat(np.maximum.reduceat(block, starts, axis=0), cols, axis=1)
+        lo = np.minimum.reduceat(np.minimum.reduceat(block, starts, axis=0), cols, axis=1)
+        pooled[r0 // factor:r0 // factor + len(starts)] = np.where(hi >= -lo, hi, lo)
+    x = np.add.reduceat(np.asarray(x, dtype=float), cols) / np.diff(np.append(cols, len(x)))
+    y = np.add.reduceat(np.asarray(y, dtype=float), rows) / np.diff(np.append(rows, len(y)))
+    return x, y, pooled
+
+
+def _span(axis, lim):
+    """Slice of the points of a monotonic axis inside `lim`, plus one point either side."""
+    low, high = sorted(lim)
+    inside = np.nonzero((axis >= low) & (axis <= high))[0]
+    if len(inside) == 0:
+        inside = [np.abs(axis - (low + high) / 2).argmin()]
+    return slice(max(inside[0] - 1, 0), min(inside[-1] + 2, len(axis)))
+
+
+class MapPyramid:
+    """Level-of-detail pyramid of a correlation map for drawing.
+
+    Level 0 is the map itself, left as it is stored (memmapped or packed maps
+    are only read tile by tile), every further level halves both axes with
+    `pool_extremes` until the coarsest fits in `max_points` per axis. `select`
+    picks the finest level whose visible window still fits in `max_points`, so
+    the overview draws the coarsest level and zooming in switches to tiles of
+    the finer ones.
+    """
+
+    def __init__(self, x, y, data, max_points=1000):
+        self.max_points = max_points
+        self.levels = [(np.asarray(x, dtype=float), np.asarray(y, dtype=float), data)]
+        while max(len(x), len(y)) > max_points:
+            x, y, data = pool_extremes(x, y, data)
+            self.levels.append((x, y, data))
+
+    def __len__(self):
+        return len(self.levels)
+
+    def overview(self):
+        return self.levels[-1]
+
+    def select(self, xlim, ylim):
+        """(level, rows, cols) of the finest level whose window over xlim/ylim has at most max_points per axis."""
+        for level, (x, y, _) in enumerate(self.levels):
+            rows, cols = _span(y, ylim), _span(x, xlim)
+            if rows.stop - rows.start <= self.max_points and cols.stop - cols.start <= self.max_points:
+                return level, rows, cols
+        x, y, _ = self.levels[-1]
+        return len(self.levels) - 1, slice(0, len(y)), slice(0, len(x))
+
+    def tile(self, level, rows, cols, margin=0.25):
+        """(rows, cols, [x, y, data]) of a window grown by `margin` of its size on every side, so small pans stay inside it."""
+        x, y, data = self.levels[level]
+        grow_r, grow_c = int((rows.stop - rows.start) * margin), int((cols.stop - cols.start) * margin)
+        rows = slice(max(rows.start - grow_r, 0), min(rows.stop + grow_r, len(y)))
+        cols = slice(max(cols.start - grow_c, 0), min(cols.stop + grow_c, len(x)))
+        return rows, cols, [x[cols], y[rows], np.asarray(data[rows, cols])]
+
+
+def create_map(path, x, y, dtype=np.float64, triangle=0):
+    """Create a binary correlation map file and return its data block as a writable memmap.
+
+    The file holds an 8 byte magic, a little-endian uint32 header length and a
+    JSON header (dtype, shape and byte offsets), followed by the float64 axis
+    vectors `x` and `y` and the raw (len(y) x len(x)) data block in C order.
+    Every block starts on a 64 byte boundary so it can be memory-mapped.
+
+    With triangle=1 (symmetric) or -1 (antisymmetric) the data block only
+    holds the packed upper triangle, see `PackedTriangle`.
+    """
+    x = np.asarray(x, dtype="<f8")
+    y = np.asarray(y, dtype="<f8")
+    dtype = np.dtype(dtype).newbyteorder("<")
+
+    def align(offset):
+        return -(-offset // _MAP_ALIGN) * _MAP_ALIGN
+
+    # Header size depends on the offsets it records, so reserve a fixed-width field for them
+    header = {"version": 1, "dtype": dtype.str, "shape": [len(y), len(x)], "triangle": triangle,
+              "x_offset": 0, "y_offset": 0, "data_offset": 0}
+    start = align(len(_MAP_MAGIC) + 4 + len(json.dumps(header)) + 3 * 20)
+    header["x_offset"] = start
+    header["y_offset"] = align(start + x.nbytes)
+    header["data_offset"] = align(header["y_offset"] + y.nbytes)
+    raw = json.dumps(header).encode()
+
+    # Unlink instead of truncating, so memmaps still open on an older file stay valid
+    if os.path.exists(path):
+        os.remove(path)
+    with open(path, "wb") as f:
+        f.write(_MAP_MAGIC + struct.pack("<I", len(raw)) + raw)
+        f.seek(header["x_offset"])
+        f.write(x.tobytes())
+        f.seek(header["y_offset"])
+        f.write(y.tobytes())
+
+    shape = (PackedTriangle.size(len(x), triangle),) if triangle else (len(y), len(x))
+    return np.memmap(path, dtype=dtype, mode="r+", offset=header["data_offset"], shape=shape)
+
+
+def save_map(path, x, y, data, dtype=np.float64):
+    """Write a (len(y) x len(x)) map, or a PackedTriangle, to a binary correlation map file."""
+    if isinstance(data, PackedTriangle):
+        out = create_map(path, x, y, dtype=dtype, triangle=data.sign)
+        out[:] = data.packed
+    else:
+        out = create_map(path, x, y, dtype=dtype)
+        out[:] = data
+    out.flush()
+    del out
+
+
+def open_map(path, mode="r"):
+    """Open a binary correlation map file, returning x, y and the data as a memmap (read lazily)."""
+    with open(path, "rb") as f:
+        if f.read(len(_MAP_MAGIC)) != _MAP_MAGIC:
+            raise ValueError(f"{path} is not a {MAP_SUFFIX} correlation map")
+        (length,) = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(length))
+
+    shape = tuple(header["shape"])
+    triangle = header.get("triangle", 0)
+    x = np.fromfile(path, dtype="<f8", count=shape[1], offset=header["x_offset"])
+    y = np.fromfile(path, dtype="<f8", count=shape[0], offset=header["y_offset"])
+    if triangle:
+        packed = np.memmap(path, dtype=np.dtype(header["dtype"]), mode=mode, offset=header["data_offset"],
+                           shape=(PackedTriangle.size(shape[1], triangle),))
+        return x, y, PackedTriangle(packed, shape[1], triangle)
+    data = np.memmap(path, dtype=np.dtype(header["dtype"]), mode=mode, offset=header["data_offset"], shape=shape)
+    return x, y, data
+
+
+@lru_cache(maxsize=1024)
+def _file_digest(path, size, mtime_ns):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """SHA-256 of a file's contents, only re-read when its size or modification time changes."""
+    stat = os.stat(path)
+    return _file_digest(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class StageCache:
+    """Content-addressed on-disk cache of pipeline results, stored as .cosmap files.
+
+    Keys are hashes of whatever identifies a result (`key`), normally the
+    key of the stage it was computed from plus that stage's parameters, so
+    a chain of stages only misses from the first changed parameter on.
+    Entries are memory-mapped on a hit. Reading an entry marks it as recently
+    used and the least recently used entries are evicted once the cache
+    grows past `max_mb`; results bigger than `max_mb` are not cached at all.
+    """
+
+    def __init__(self, root=CACHE_DIR, max_mb=1024):
+        self.root = root
+        self.max_bytes = int(max_mb * 1e6)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key + MAP_SUFFIX)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """(x, y, data) stored under `key`, or None on a miss."""
+        path = self._path(key)
+        try:
+            entry = open_map(path)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return entry
+
+    def put(self, key, x, y, data):
+        """Store a map (or a spectra set, x = spectrum number) and evict down to the size limit.
+
+        An entry larger than the whole cache is not stored: it would only
+        evict every other entry and be rewritten on the next run anyway.
+        """
+        stored = data.packed if isinstance(data, PackedTriangle) else data
+        if stored.nbytes > self.max_bytes:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        tmp = os.path.join(self.root, f"{key}.{os.getpid()}.tmp")
+        save_map(tmp, x, y, data)
+        os.replace(tmp, self._path(key))
+        self.evict(keep=key)
+
+    def get_spectra(self, key):
+        """(x, spectra) stored with `put_spectra`, as a writable copy, or None on a miss."""
+        entry = self.get(key)
+        return None if entry is None else (np.array(entry[1]), np.array(entry[2]))
+
+    def put_spectra(self, key, x, spectra):
+        self.put(key, np.arange(1, spectra.shape[1] + 1), x, spectra)
+
+    def fetch_map(self, key, compute, x, y):
+        """Cached map under `key`, computing and storing it with `compute()` on a miss."""
+        entry = self.get(key)
+        if entry is not None:
+            return entry[2]
+        data = compute()
+        self.put(key, x, y, data)
+        return data
+
+    def entries(self):
+        """(path, size, last use) of every entry, least recently used first."""
+        if not os.path.isdir(self.root):
+            return []
+        found = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(MAP_SUFFIX):
+                stat = entry.stat()
+                found.append((entry.path, stat.st_size, stat.st_mtime))
+        return sorted(found, key=lambda item: item[2])
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """Drop least recently used entries until the cache fits in `max_bytes`."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if keep is not None and path == self._path(keep):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Still mapped elsewhere (Windows); try again on the next eviction
+                continue
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def run_stages(load, stages, cache=None, timer=None):
+    """Load a spectra set and run its preprocessing stages, resuming from the deepest cached stage.
+
+    `load` is (name, title, paths, func[, params]) where func(paths) returns
+    (x, spectra) and the optional params are anything else that decides what
+    it loads; each stage is (name, title, params, func) where func(x, spectra)
+    changes `spectra` in place. The raw set is keyed by the contents of
+    `paths` and the load params, each stage by the key before it plus its
+    `params`, so a change to one stage reuses every result upstream of it.
+    Returns (x, spectra, key).
+    """
+    timer = timer or StageTimer()
+    name, title, paths, func = load[:4]
+    names = [name] + [stage[0] for stage in stages]
+    keys = [None] * len(names)
+    if cache is not None:
+        keys[0] = StageCache.key("raw", [file_digest(p) for p in paths], *load[4:])
+        for i, (_, _, params, _) in enumerate(stages, start=1):
+            keys[i] = StageCache.key(keys[i - 1], params)
+
+    start, cached = 0, None
+    for start in reversed(range(len(keys)) if cache is not None else []):
+        if keys[start] in cache:
+            with timer.stage(f"{names[start]} (cached)", "Loading Cached Spectra"):
+                cached = cache.get_spectra(keys[start])
+            if cached is not None:
+                break
+
+    if cached is None:
+        start = 0
+        with timer.stage(name, title):
+            x, spectra = func(paths)
+        if cache is not None:
+            cache.put_spectra(keys[0], x, spectra)
+    else:
+        x, spectra = cached
+
+    for (stage_name, stage_title, _, func), key in zip(stages[start:], keys[start + 1:]):
+        with timer.stage(stage_name, stage_title):
+            func(x, spectra)
+        if cache is not None:
+            cache.put_spectra(key, x, spectra)
+    return x, spectra, keys[-1]
+
+
+class TwoDCOS:
+    """In-memory 2D correlation of one spectra set (homo) or two sets (hetero).
+
+    `spectra1` and `spectra2` are (n x m) arrays holding one preprocessed
+    spectrum per column on the wavenumber axes `x1` and `x2`, the same layout
+    as the combined table built by Make_Mesh. The correlation maps are stored
+    as they are plotted: rows follow `x2` and columns follow `x1`.
+
+    With packed=True a homo correlation only computes and stores the upper
+    triangle of each map (see `PackedTriangle`); the synchronous map is
+    symmetric and the asynchronous one antisymmetric, so nothing is lost.
+
+    `roi`, `bin_size` and `reduce` are handed to `crop_and_bin` for both sets
+    before anything is correlated, so the maps only cover the window of
+    interest at the requested resolution.
+
+    resample="linear" or "cubic" first maps both sets onto one evenly spaced
+    `common_grid` over their shared range (`resample_step` apart, by default
+    the coarser of the two spacings), so sets recorded on different
+    instruments correlate point for point.
+
+    Out-of-core mode (`out_dir` set) computes the maps in row tiles of at
+    most `memory_budget` MB and streams every tile into `_sync.<run>.cosmap`
+    and `_async.<run>.cosmap` inside `out_dir`; the maps are then kept as
+    read-only memmaps, so peak memory no longer grows with n x n. Every run
+    writes new files, since the maps of an earlier run may still be mapped
+    (Windows refuses to delete those); earlier files are removed once they
+    can be. `memory_budget` on its
+    own only tiles the in-memory products. `workers` > 1 computes the tiles
+    on a thread pool; every worker holds one tile, so the budget applies per
+    worker.
+    """
+
+    def __init__(self, x1, spectra1, x2=None, spectra2=None, engine="noda", packed=False,
+                 roi=None, bin_size=1, reduce="mean", out_dir=None, memory_budget=None, workers=1,
+                 resample=None, resample_step=None):
+        self.hetero = spectra2 is not None
+        if resample is not None:
+            grid = common_grid([x1, x2] if self.hetero else [x1], resample_step)
+            spectra1 = resample_spectra(x1, spectra1, grid, resample)
+            if self.hetero:
+                spectra2 = resample_spectra(x2, spectra2, grid, resample)
+            x1 = x2 = grid
+        self.x1, self.spectra1 = crop_and_bin(x1, spectra1, roi, bin_size, reduce)
+        if self.hetero:
+            self.x2, self.spectra2 = crop_and_bin(x2, spectra2, roi, bin_size, reduce)
+        else:
+            self.x2, self.spectra2 = self.x1, self.spectra1
+
+        if self.spectra1.shape[1] != self.spectra2.shape[1]:
+            raise ValueError(f"Data mismatching: len1 = {self.spectra1.shape[1]}, len2 = {self.spectra2.shape[1]}")
+        if self.spectra1.shape[1] < 2:
+            # The maps are scaled by 1 / (m - 1), so a single spectrum has no correlation
+            raise ValueError("At least two spectra are needed for a correlation")
+        if engine not in ASYNC_ENGINES:
+            raise ValueError(f"Unknown asynchronous engine {engine!r}, expected one of {ASYNC_ENGINES}")
+
+        self.engine = engine
+        self.packed = packed and not self.hetero
+        self.out_dir = out_dir
+        self.memory_budget = memory_budget
+        self.workers = workers
+        self.sync = None
+        self.asyn = None
+        self._paths = {}
+
+    @property
+    def n_spectra(self):
+        return self.spectra1.shape[1]
+
+    def _dynamic(self):
+        dyn1 = self.spectra1 - self.spectra1.mean(axis=1, keepdims=True)
+        dyn2 = self.spectra2 - self.spectra2.mean(axis=1, keepdims=True) if self.hetero else dyn1
+        return dyn1, dyn2
+
+    def _output(self, name, triangle=0):
+        """Memmapped output file for out-of-core mode, None to compute in memory."""
+        if self.out_dir is None:
+            return None
+        os.makedirs(self.out_dir, exist_ok=True)
+        for stale in glob.glob(os.path.join(glob.escape(self.out_dir), f"{name}.*{MAP_SUFFIX}")):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass  # Still mapped by an earlier figure, removed on a later run
+        self._paths[name] = os.path.join(self.out_dir, f"{name}.{uuid.uuid4().hex[:12]}{MAP_SUFFIX}")
+        return create_map(self._paths[name], self.x1, self.x2, triangle=triangle)
+
+    def _finish(self, name, data):
+        if self.out_dir is None:
+            return data
+        out = data.packed if isinstance(data, PackedTriangle) else data
+        out.flush()
+        del out, data
+        return open_map(self._paths[name])[2]
+
+    def compute_sync(self):
+        """Synchronous map, (n2 x n1)."""
+        dyn1, dyn2 = self._dynamic()
+        scale = 1 / (self.n_spectra - 1)
+        block = block_rows(len(self.x1), self.memory_budget)
+        if self.packed:
+            sync = PackedTriangle.from_product(dyn1, dyn1.T, sign=1, scale=scale, block=block,
+                                               out=self._output("_sync", triangle=1), workers=self.workers)
+        else:
+            sync = tiled_product(dyn2, dyn1.T, scale=scale, block=block, out=self._output("_sync"),
+                                 workers=self.workers)
+        self.sync = self._finish("_sync", sync)
+        return self.sync
+
+    def compute_async(self):
+        """Asynchronous map, (n2 x n1)."""
+        dyn1, dyn2 = self._dynamic()
+        # The stored map is the transpose of dyn1 @ N @ dyn2.T, i.e. -dyn2 @ N @ dyn1.T
+        ortho = orthogonal_spectra(dyn1.T, self.engine)
+        scale = -1 / (self.n_spectra - 1)
+        block = block_rows(len(self.x1), self.memory_budget)
+        if self.packed:
+            asyn = PackedTriangle.from_product(dyn1, ortho, sign=-1, scale=scale, block=block,
+                                               out=self._output("_async", triangle=-1), workers=self.workers)
+        else:
+            asyn = tiled_product(dyn2, ortho, scale=scale, block=block, out=self._output("_async"),
+                                 workers=self.workers)
+        self.asyn = self._finish("_async", asyn)
+        return self.asyn
+
+    def compute(self):
+        self.compute_sync()
+        self.compute_async()
+        return self
+
+    def _map(self, asynchronous):
+        if asynchronous:
+            return self.asyn if self.asyn is not None else self.compute_async()
+        return self.sync if self.sync is not None else self.compute_sync()
+
+    def correlation(self, asynchronous=False):
+        """[x, y, map] for the synchronous or asynchronous plot, computing the map if needed.
+
+        Packed maps are expanded to a full square array on every call.
+        """
+        return [self.x1, self.x2, np.asarray(self._map(asynchronous))]
+
+    def plot_data(self, asynchronous=False):
+        """Correlation, mean spectra and spectra sets in the layout COS_Plot draws from.
+
+        The map is passed on as stored (array, memmap or `PackedTriangle`), so
+        large maps are only read in blocks while drawing.
+        """
+        Input = [self.x1, self.spectra1.mean(axis=1),
+                 self.x2 if self.hetero else None,
+                 self.spectra2.mean(axis=1) if self.hetero else None]
+        spect2 = (self.x2, self.spectra2) if self.hetero else None
+        return [self.x1, self.x2, self._map(asynchronous)], Input, (self.x1, self.spectra1), spect2
+
+    def export_csv(self, folder="."):
+        """Write Combined.csv (Combined2.csv), _sync.csv and _async.csv into `folder`."""
+        sets = [(self.x1, self.spectra1, "Combined.csv")]
+        if self.hetero:
+            sets.append((self.x2, self.spectra2, "Combined2.csv"))
+        for x, spectra, name in sets:
+            combined = pd.DataFrame(spectra, columns=range(1, spectra.shape[1] + 1))
+            combined.insert(0, "", x)
+            combined.to_csv(os.path.join(folder, name), index=False)
+
+        for data, name in [(self.correlation()[2], "_sync.csv"), (self.correlation(True)[2], "_async.csv")]:
+            pd.DataFrame(data, index=self.x2, columns=self.x1).to_csv(os.path.join(folder, name))
+
+    def save(self, folder=".", dtype=np.float64):
+        """Write the spectra sets and both maps as binary .cosmap files into `folder`.
+
+        Spectra sets are stored with the spectrum number as x and the
+        wavenumber as y, so every file shares the same format.
+        """
+        sets = [(self.x1, self.spectra1, "Combined")]
+        if self.hetero:
+            sets.append((self.x2, self.spectra2, "Combined2"))
+        elif os.path.exists(os.path.join(folder, "Combined2" + MAP_SUFFIX)):
+            # A second set left over from a hetero run would make `load` treat this one as hetero
+            os.remove(os.path.join(folder, "Combined2" + MAP_SUFFIX))
+        for x, spectra, name in sets:
+            save_map(os.path.join(folder, name + MAP_SUFFIX), np.arange(1, spectra.shape[1] + 1), x, spectra)
+
+        if self.sync is None or self.asyn is None:
+            self.compute()
+        for data, name in [(self.sync, "_sync"), (self.asyn, "_async")]:
+            save_map(os.path.join(folder, name + MAP_SUFFIX), self.x1, self.x2, data, dtype=dtype)
+
+    @classmethod
+    def load(cls, folder="."):
+        """Re-open a set written by `save`; the maps stay memory-mapped until they are used."""
+        _, x1, spectra1 = open_map(os.path.join(folder, "Combined" + MAP_SUFFIX))
+        second = os.path.join(folder, "Combined2" + MAP_SUFFIX)
+        x2, spectra2 = open_map(second)[1:] if os.path.exists(second) else (None, None)
+
+        sync = open_map(os.path.join(folder, "_sync" + MAP_SUFFIX))[2]
+        cos = cls(x1, spectra1, x2, spectra2, packed=isinstance(sync, PackedTriangle))
+        cos.sync = sync
+        cos.asyn = open_map(os.path.join(folder, "_async" + MAP_SUFFIX))[2]
+        return cos
+
+
+class IncrementalCOS:
+    """2D correlation of a perturbation series that grows one spectrum at a time.
+
+    Instead of the spectra themselves the maps are kept as running sums:
+    sum(y2_k y1_k^T) and sum(y_k) for the synchronous map, and
+    sum(N_jk y2_j y1_k^T) and sum(r_j y_j) (r_j being the row sums of the
+    Hilbert-Noda matrix N) for the asynchronous one. N_jk only depends on
+    k - j, so appending spectrum p adds a row and a column to N without
+    changing the rest: the synchronous sum gets a rank-one update and the
+    asynchronous sum a rank-two update built from h = sum_j y_j / (pi (p - j)).
+    An append costs O(n^2 + n m) instead of a full recomputation, and the
+    mean-centred maps are recovered from the sums whenever they are read.
+
+    Spectra are stored relative to the first one, which leaves the centred
+    maps unchanged but keeps the sums from cancelling catastrophically.
+    `roi`, `bin_size` and `reduce` are applied to every appended spectrum as
+    in `TwoDCOS`.
+    """
+
+    def __init__(self, x1, x2=None, roi=None, bin_size=1, reduce="mean"):
+        self.hetero = x2 is not None
+        self._raw_x = (np.asarray(x1, dtype=float), None if x2 is None else np.asarray(x2, dtype=float))
+        self.roi, self.bin_size, self.reduce = roi, bin_size, reduce
+        self.x1 = crop_and_bin(x1, np.zeros((len(x1), 1)), roi, bin_size, reduce)[0]
+        self.x2 = crop_and_bin(x2, np.zeros((len(x2), 1)), roi, bin_size, reduce)[0] if self.hetero else self.x1
+        self.n_spectra = 0
+
+        n1, n2 = len(self.x1), len(self.x2)
+        self._ref = [None, None]
+        self._buffer = [np.empty((n1, 8)), np.empty((n2, 8)) if self.hetero else None]
+        self._sum = [np.zeros(n1), np.zeros(n2) if self.hetero else None]
+        self._row = [np.zeros(n1), np.zeros(n2) if self.hetero else None]
+        self._sync = np.zeros((n2, n1))
+        self._asyn = np.zeros((n2, n1))
+
+    def _prepare(self, i, x, spectra):
+        if x is not None and not np.array_equal(np.asarray(x, dtype=float), self._raw_x[i]):
+            raise ValueError(f"Spectra set {i + 1} is not on the wavenumber axis of the series")
+        spectra = np.asarray(spectra, dtype=float).reshape(len(self._raw_x[i]), -1)
+        return crop_and_bin(self._raw_x[i], spectra, self.roi, self.bin_size, self.reduce)[1]
+
+    def _store(self, i, spectra):
+        """Append to the spectra buffer of set i, doubling it when full."""
+        if self._ref[i] is None:
+            self._ref[i] = spectra[:, 0].copy()
+        buffer = self._buffer[i]
+        m, k = self.n_spectra, spectra.shape[1]
+        if m + k > buffer.shape[1]:
+            grown = np.empty((buffer.shape[0], max(2 * buffer.shape[1], m + k)))
+            grown[:, :m] = buffer[:, :m]
+            self._buffer[i] = buffer = grown
+        buffer[:, m:m + k] = spectra
+
+    def extend(self, spectra1, spectra2=None, x1=None, x2=None):
+        """Append (n x k) preprocessed spectra, one per column and in perturbation order.
+
+        `x1` and `x2`, when given, are checked against the axes the series
+        was started with.
+        """
+        if self.hetero == (spectra2 is None):
+            raise ValueError("A hetero series needs both spectra sets, a homo series only the first")
+        new1 = self._prepare(0, x1, spectra1)
+        new2 = self._prepare(1, x2, spectra2) if self.hetero else new1
+        if new1.shape[1] != new2.shape[1]:
+            raise ValueError(f"Data mismatching: len1 = {new1.shape[1]}, len2 = {new2.shape[1]}")
+        self._store(0, new1)
+        if self.hetero:
+            self._store(1, new2)
+
+        sets = [0, 1] if self.hetero else [0]
+        for p in range(self.n_spectra, self.n_spectra + new1.shape[1]):
+            # Column p of the Hilbert-Noda matrix above the diagonal, N_jp = 1 / (pi (p - j))
+            w = 1 / (math.pi * (p - np.arange(p)))
+            y, h = {}, {}
+            for i in sets:
+                y[i] = self._buffer[i][:, p] - self._ref[i]
+                h[i] = self._buffer[i][:, :p] @ w - self._ref[i] * w.sum()
+                self._sum[i] += y[i]
+                self._row[i] += h[i] - w.sum() * y[i]
+            y2, h2 = y[sets[-1]], h[sets[-1]]
+            self._sync += np.outer(y2, y[0])
+            self._asyn += np.outer(h2, y[0]) - np.outer(y2, h[0])
+
+        self.n_spectra += new1.shape[1]
+        return self
+
+    def append(self, spectrum1, spectrum2=None):
+        """Append a single spectrum (one per set for hetero series)."""
+        return self.extend(np.asarray(spectrum1)[:, None], None if spectrum2 is None else np.asarray(spectrum2)[:, None])
+
+    def _centred(self):
+        if self.n_spectra < 2:
+            raise ValueError("At least two spectra are needed for a correlation")
+        second = 1 if self.hetero else 0
+        return self._sum[0], self._sum[second], self._row[0], self._row[second]
+
+    @property
+    def sync(self):
+        """Synchronous map, (n2 x n1)."""
+        s1, s2, _, _ = self._centred()
+        m = self.n_spectra
+        return (self._sync - np.outer(s2, s1) / m) / (m - 1)
+
+    @property
+    def asyn(self):
+        """Asynchronous map, (n2 x n1), in the same orientation as `TwoDCOS.asyn`."""
+        s1, s2, r1, r2 = self._centred()
+        m = self.n_spectra
+        # sum N_jk (y2_j - mean2)(y1_k - mean1)^T; the column sums of N are minus its row sums
+        centred = self._asyn - np.outer(r2, s1 / m) + np.outer(s2 / m, r1)
+        return -centred / (m - 1)
+
+    @property
+    def spectra1(self):
+        return self._buffer[0][:, :self.n_spectra]
+
+    @property
+    def spectra2(self):
+        return self._buffer[1][:, :self.n_spectra] if self.hetero else self.spectra1
+
+    def to_cos(self):
+        """Snapshot as a `TwoDCOS` with both maps filled in, for plotting and export."""
+        self._centred()  # at least two spectra
+        cos = TwoDCOS(self.x1, self.spectra1.copy(), self.x2 if self.hetero else None,
+                      self.spectra2.copy() if self.hetero else None)
+        cos.sync, cos.asyn = self.sync, self.asyn
+        return cos
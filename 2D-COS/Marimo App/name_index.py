@@ -0,0 +1,241 @@
+"""Index of spectrum files by the metadata in their names, following a BEA-NameBuilder convention.
+
+A convention JSON (as exported by the NameBuilder app) lists the metadata in
+`MetadataOrder`, how each one is written in `MetadataKeys` and the
+`Separators` between them. `name_pattern` turns it into one regular
+expression, the reverse of `generate_filename`. For example
+ACBCM_KMS0007_ATR_20241126_01 follows
+
+    {"MetadataOrder": ["Project", "Material", "Initials", "Sample", "Technique", "Production", "Numerator"],
+     "Separators": ["None (Joined)", "Underscore <_>", "None (Joined)",
+                    "Underscore <_>", "Underscore <_>", "Underscore <_>"],
+     "MetadataKeys": {"Project": {"Type": "Categorical", "Categories": {"Key": {"0": "ACB"}, ...}},
+                      ...
+                      "Sample": {"Type": "Numerical", "Digits": 4, "Lower": 1, "Upper": 9999},
+                      "Production": {"Type": "DateType", "Format": "YYYYMMDD"},
+                      "Numerator": {"Type": "Numerical", "Digits": 2, "Lower": 1, "Upper": 99}}}
+
+`NameIndex` keeps the parsed names of every spectrum file under some
+folders in an SQLite file, with one indexed column per metadata key, and
+only re-parses files that were added or changed since the last `update`.
+Queries by category, date range and number range then pick a series out of
+thousands of files without touching the files themselves:
+
+    index = NameIndex("IR-Index.sqlite", "ACBCM.json")
+    index.update("../IR-Data")
+    paths = index.query(Project="ACB", Production=("2024-11-26", "2024-11-29"), order_by="Production")
+"""
+import json
+import os
+import re
+import sqlite3
+from datetime import date, datetime
+
+import pandas as pd
+
+import spectra_io
+
+SEPARATORS = {"Underscore <_>": "_", "Dash <->": "-", "None (Joined)": ""}
+DATE_FORMATS = {"YYYYMMDD": "%Y%m%d", "MMDDYYYY": "%m%d%Y", "DDMMYYYY": "%d%m%Y",
+                "YYYYDDMM": "%Y%d%m", "MMYY": "%m%y", "YYMM": "%y%m"}
+REQUIRED_KEYS = ("ConventionName", "MetadataOrder", "MetadataKeys", "Separators")
+
+
+def load_convention(convention):
+    """Convention dict from a JSON path (or a dict, returned as is), checked like the NameBuilder app does."""
+    if not isinstance(convention, dict):
+        with open(convention, "r", encoding="utf-8") as file:
+            convention = json.load(file)
+    missing = [key for key in REQUIRED_KEYS if key not in convention]
+    if missing:
+        raise ValueError(f"Invalid convention format, missing {', '.join(missing)}")
+    if len(convention["Separators"]) != len(convention["MetadataOrder"]) - 1:
+        raise ValueError("Invalid convention format, expected one separator between each pair of metadata")
+    for key in convention["MetadataOrder"]:
+        if key not in convention["MetadataKeys"]:
+            raise ValueError(f"Metadata key {key} not found in MetadataKeys")
+    return convention
+
+
+def _categories(meta):
+    keys = meta.get("Categories", {}).get("Key", [])
+    return list(keys.values()) if isinstance(keys, dict) else list(keys)
+
+
+def _field_pattern(meta):
+    kind = meta["Type"]
+    if kind == "DateType":
+        return r"\d{%d}" % len(meta["Format"])
+    if kind == "Numerical":
+        digits = int(meta.get("Digits", 0))
+        return r"\d{%d}" % digits if digits else r"\d+"
+    if kind == "Categorical":
+        # Longest first, so "AB" is not taken for the start of "ABC"
+        keys = sorted(_categories(meta), key=len, reverse=True)
+        return "|".join(map(re.escape, keys)) or r"(?!)"
+    raise ValueError(f"Unknown metadata type {kind!r}")
+
+
+def name_pattern(convention):
+    """Compiled regular expression matching a whole file name (without extension) of `convention`.
+
+    Group i holds the i-th key of MetadataOrder.
+    """
+    convention = load_convention(convention)
+    parts = []
+    for i, key in enumerate(convention["MetadataOrder"]):
+        if i:
+            parts.append(re.escape(SEPARATORS[convention["Separators"][i - 1]]))
+        parts.append(f"(?P<g{i}>{_field_pattern(convention['MetadataKeys'][key])})")
+    return re.compile("".join(parts))
+
+
+def parse_name(convention, name, pattern=None):
+    """{key: value} of a file name, or None if it does not follow `convention`.
+
+    Dates become datetime.date (the 1st of the month for MMYY/YYMM), numbers
+    int (None outside Lower-Upper makes the name invalid) and categories
+    their key.
+    """
+    convention = load_convention(convention)
+    match = (pattern or name_pattern(convention)).fullmatch(name)
+    if match is None:
+        return None
+
+    values = {}
+    for i, key in enumerate(convention["MetadataOrder"]):
+        meta, text = convention["MetadataKeys"][key], match[f"g{i}"]
+        if meta["Type"] == "DateType":
+            try:
+                values[key] = datetime.strptime(text, DATE_FORMATS[meta["Format"]]).date()
+            except ValueError:
+                return None
+        elif meta["Type"] == "Numerical":
+            number = int(text)
+            if not meta.get("Lower", number) <= number <= meta.get("Upper", number):
+                return None
+            values[key] = number
+        else:
+            values[key] = text
+    return values
+
+
+def _sql_value(value):
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.isoformat() if isinstance(value, date) else value
+
+
+class NameIndex:
+    """Persistent SQLite index of spectrum files parsed against one naming convention.
+
+    Files that do not follow the convention are kept (so they are not
+    re-parsed on every update) with `matched` = 0 and no metadata.
+    """
+
+    def __init__(self, path, convention):
+        self.path = path
+        self.convention = load_convention(convention)
+        self.keys = list(self.convention["MetadataOrder"])
+        self.pattern = name_pattern(self.convention)
+        self.connection = sqlite3.connect(path)
+
+        signature = json.dumps(self.convention, sort_keys=True)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS convention (json TEXT)")
+            stored = self.connection.execute("SELECT json FROM convention").fetchone()
+            if stored is None or stored[0] != signature:
+                # A different convention means different columns, so the index starts over
+                self.connection.execute("DROP TABLE IF EXISTS files")
+                self.connection.execute("DELETE FROM convention")
+                self.connection.execute("INSERT INTO convention VALUES (?)", (signature,))
+            columns = "".join(f', "{key}"' for key in self.keys)
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, name TEXT, "
+                                    f"size INTEGER, mtime_ns INTEGER, matched INTEGER{columns})")
+            for i, key in enumerate(self.keys):
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS key_{i} ON files ("{key}")')
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files WHERE matched").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, *folders, filetypes=spectra_io.FILETYPES):
+        """Scan `folders` recursively, parse new and changed files and forget deleted ones.
+
+        Returns (files parsed, files removed).
+        """
+        known = {path: (size, mtime) for path, size, mtime in
+                 self.connection.execute("SELECT path, size, mtime_ns FROM files")}
+        seen, rows = set(), []
+        for folder in folders:
+            for root, _, files in os.walk(folder):
+                for file in files:
+                    if not file.lower().endswith(filetypes):
+                        continue
+                    path = os.path.abspath(os.path.join(root, file))
+                    stat = os.stat(path)
+                    seen.add(path)
+                    if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                        continue
+                    name = os.path.splitext(file)[0]
+                    values = parse_name(self.convention, name, self.pattern) or {}
+                    rows.append((path, name, stat.st_size, stat.st_mtime_ns, bool(values),
+                                 *(_sql_value(values.get(key)) for key in self.keys)))
+
+        roots = tuple(os.path.join(os.path.abspath(folder), "") for folder in folders)
+        removed = [(path,) for path in known if path.startswith(roots) and path not in seen]
+        with self.connection:
+            placeholders = ", ".join("?" * (5 + len(self.keys)))
+            self.connection.executemany(f"INSERT OR REPLACE INTO files VALUES ({placeholders})", rows)
+            self.connection.executemany("DELETE FROM files WHERE path = ?", removed)
+        return len(rows), len(removed)
+
+    def _where(self, criteria):
+        clauses, params = ["matched"], []
+        for key, wanted in criteria.items():
+            if key not in self.keys:
+                raise KeyError(f"No metadata key {key!r} in the convention, expected one of {self.keys}")
+            column = f'"{key}"'
+            if isinstance(wanted, tuple):
+                # (low, high) range, None leaves that end open
+                low, high = (_sql_value(bound) for bound in wanted)
+                if low is not None:
+                    clauses.append(f"{column} >= ?")
+                    params.append(low)
+                if high is not None:
+                    clauses.append(f"{column} <= ?")
+                    params.append(high)
+            elif isinstance(wanted, (list, set, frozenset)):
+                wanted = [_sql_value(value) for value in wanted]
+                clauses.append(f"{column} IN ({', '.join('?' * len(wanted))})")
+                params += wanted
+            else:
+                clauses.append(f"{column} = ?")
+                params.append(_sql_value(wanted))
+        return " AND ".join(clauses), params
+
+    def query(self, order_by=None, **criteria):
+        """Paths of the files matching every criterion, ordered by `order_by` (a key) and then path.
+
+        A criterion is a value (equality), a list or set of accepted values,
+        or a (low, high) tuple for an inclusive range of dates or numbers.
+        Dates may be datetime.date or ISO "YYYY-MM-DD" strings.
+        """
+        if order_by and order_by not in self.keys:
+            raise KeyError(f"No metadata key {order_by!r} in the convention, expected one of {self.keys}")
+        where, params = self._where(criteria)
+        order = f'"{order_by}", path' if order_by else "path"
+        return [path for (path,) in self.connection.execute(
+            f"SELECT path FROM files WHERE {where} ORDER BY {order}", params)]
+
+    def frame(self, **criteria):
+        """DataFrame of the matching files with their metadata, one row per file."""
+        where, params = self._where(criteria)
+        return pd.read_sql_query(f"SELECT * FROM files WHERE {where} ORDER BY path", self.connection,
+                                 params=params)
+
+    def unmatched(self):
+        """Paths of indexed files whose names do not follow the convention."""
+        return [path for (path,) in self.connection.execute("SELECT path FROM files WHERE NOT matched ORDER BY path")]
@@ -0,0 +1,168 @@
+"""Spectrum file readers shared by the 2D-COS app and the graph templates.
+
+One reader covers the layouts the lab actually has on disk:
+
+    3999.09758,0.04180                      OPUS .dpt export, no header, descending
+    3.991926e+002, 0.000000e+000            RRUFF .txt, comma + space, ascending
+    3999,09758;0,04180                      European export, semicolons and decimal commas
+    Wavenumber,ACBCM_KMS0007_...,...        wide CSV, one spectrum per column
+
+`sniff` looks at the first lines of a file to find the delimiter, the
+decimal mark, whether there is a header row and which way the axis runs; the file is then parsed
+once by pandas' C engine. Parsed files are kept in memory (keyed on path,
+size and modification time), so re-running a cell or a marimo app does not
+parse them again.
+
+Parquet spectral libraries (see spectral_library) are read like a wide CSV.
+For them `names` and `xlim` pick spectra and a wavenumber range, so only
+those columns and row groups are read.
+"""
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+FILETYPES = (".csv", ".dpt", ".txt")
+LIBRARY_SUFFIX = ".parquet"
+DELIMITERS = (";", "\t", ",")
+WHITESPACE = r"\s+"
+
+Layout = namedtuple("Layout", "delimiter decimal header columns descending comment")
+
+
+def _is_number(field, decimal="."):
+    try:
+        float(field.replace(decimal, "."))
+    except ValueError:
+        return False
+    return True
+
+
+def _fields(line, delimiter):
+    return line.split() if delimiter == WHITESPACE else [field.strip() for field in line.split(delimiter)]
+
+
+def sniff(path, lines=5):
+    """Layout of a spectrum file, read from its first few lines.
+
+    The delimiter is the first of `DELIMITERS` that splits every data line
+    into the same number of fields, otherwise runs of whitespace; ";" and
+    tab come first, since a file split by them may use "," as its decimal
+    mark. The decimal mark is "," when the delimiter is not and the fields
+    hold decimal commas. The first line is a header if its first field is
+    not a number. Leading `#` lines (RRUFF metadata) are treated as comments.
+    """
+    head, comment = [], None
+    with open(path, "r", encoding="utf-8", errors="replace") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("#"):
+                comment = "#"
+                continue
+            head.append(line)
+            if len(head) > lines:
+                break
+    if not head:
+        raise ValueError(f"{path} has no data lines")
+
+    data = head[1:] if len(head) > 1 else head
+    counts = {d: {line.count(d) for line in data} for d in DELIMITERS}
+    delimiter = next((d for d in DELIMITERS if len(counts[d]) == 1 and 0 not in counts[d]), WHITESPACE)
+    fields = [field for line in data for field in _fields(line, delimiter)]
+    decimal = "," if delimiter != "," and any("," in field and _is_number(field, ",") for field in fields) else "."
+
+    header = None if _is_number(_fields(head[0], delimiter)[0], decimal) else 0
+    rows = [_fields(line, delimiter) for line in (head[1:] if header == 0 else head)]
+    if len(rows) < 2:
+        raise ValueError(f"{path} has fewer than two data points")
+    first, second = (float(row[0].replace(decimal, ".")) for row in rows[:2])
+    return Layout(delimiter, decimal, header, len(rows[0]), first > second, comment)
+
+
+def _library(path):
+    # Imported here so pyarrow is only needed once a library is opened
+    import spectral_library
+    return spectral_library.SpectralLibrary(path)
+
+
+def library_names(path):
+    """Names of the spectra in a Parquet spectral library, read from its footer only."""
+    return _library(path).names
+
+
+@lru_cache(maxsize=256)
+def _parse(path, size, mtime_ns, header, names=None, xlim=None):
+    if path.endswith(LIBRARY_SUFFIX):
+        library = _library(path)
+        if names is not None:
+            names = [name for name in library.names if name in names]
+        frame = library.read_table(names, xlim)
+        values = frame.to_numpy(dtype=float)
+        values.flags.writeable = False
+        return values[:, 0], values[:, 1:], list(frame.columns)
+
+    layout = sniff(path)
+    if header == "infer":
+        header = layout.header
+    frame = pd.read_csv(path, sep=layout.delimiter, decimal=layout.decimal, header=header,
+                        comment=layout.comment, skipinitialspace=True, engine="c")
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if header is None:
+        names = [stem] if frame.shape[1] == 2 else [f"{stem}_{j}" for j in range(1, frame.shape[1])]
+        names.insert(0, "Wavenumber")
+    else:
+        names = [str(name) for name in frame.columns]
+
+    values = frame.to_numpy(dtype=float)
+    values.flags.writeable = False
+    return values[:, 0], values[:, 1:], names
+
+
+def _cached(path, header, names=None, xlim=None):
+    stat = os.stat(path)
+    if names is not None:
+        names = tuple(sorted(names))
+    if xlim is not None:
+        xlim = tuple(sorted(float(limit) for limit in xlim))
+    return _parse(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, header, names, xlim)
+
+
+def read_spectra(path, header="infer", names=None, xlim=None):
+    """(x, spectra) of a spectrum file: the axis and an (n x k) array with one spectrum per column.
+
+    header="infer" sniffs for a header row, None reads every line as data and
+    an int is the header row as in pd.read_csv. For a library, `names` keeps
+    only the spectra named in it (in library order) and `xlim=(low, high)`
+    only that wavenumber range; other files are always read whole. The
+    arrays are shared with the parse cache and read-only, so copy them
+    before editing in place.
+    """
+    x, spectra, _ = _cached(path, header, names, xlim)
+    return x, spectra
+
+
+def read_table(path, header="infer", names=None, xlim=None):
+    """Spectrum file as a DataFrame: an x column followed by one column per spectrum.
+
+    Header rows keep their column names. Headerless files get a "Wavenumber"
+    column and the file name for the spectrum (numbered when there are
+    several). `names` and `xlim` select from libraries as in `read_spectra`.
+    """
+    x, spectra, names = _cached(path, header, names, xlim)
+    return pd.DataFrame(np.column_stack([x, spectra]), columns=names)
+
+
+def read_folder(folder, filetypes=FILETYPES, header="infer"):
+    """{file name without extension: read_table(...)} for every spectrum file in `folder`, sorted by name."""
+    return {os.path.splitext(file)[0]: read_table(os.path.join(folder, file), header=header)
+            for file in sorted(os.listdir(folder)) if file.lower().endswith(tuple(filetypes))}
+
+
+def clear_cache():
+    """Forget every parsed file."""
+    _parse.cache_clear()
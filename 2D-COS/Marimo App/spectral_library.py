@@ -0,0 +1,156 @@
+"""Columnar spectral library: a folder of spectrum files packed into one Parquet file.
+
+The library is a single wide table, a "Wavenumber" column followed by one
+float column per spectrum, written in row groups along the (sorted) axis.
+Loading a few spectra only reads their columns (projection) and a
+wavenumber range only reads the row groups that overlap it (predicate
+pushdown on the row group statistics), so a plot of three spectra between
+1200 and 1000 cm-1 touches a small part of an archive of hundreds.
+
+Per-spectrum metadata (file, range, number of points and the fields parsed
+from the spectrum name, e.g. ACBCM_KMS0007_ATR_20241126_01) is kept as JSON
+in the Parquet footer and is read without touching the data.
+
+    library = build_library("../IR-Data", "../IR-Data/library.parquet",
+                            keys=("project", "sample", "technique", "date", "run"))
+    names = library.select(project="ACBCM", technique="ATR")
+    x, spectra = library.read_spectra(names, xlim=(1000, 1200))
+"""
+import json
+import os
+import re
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import cos_engine
+import spectra_io
+
+LIBRARY_SUFFIX = spectra_io.LIBRARY_SUFFIX
+ROW_GROUP_SIZE = 512
+_META_KEY = b"spectral_library"
+
+
+def split_name(name, keys=None, separators="_-"):
+    """Fields of a spectrum name split at `separators`, e.g. "ACBCM_KMS0007_ATR_20241126_01".
+
+    With `keys` the fields are named in order (missing fields are left out,
+    extra ones are numbered); otherwise they are "field_1", "field_2", ...
+    """
+    parts = [part for part in re.split(f"[{re.escape(separators)}]", name) if part]
+    keys = list(keys or [])
+    return {keys[i] if i < len(keys) else f"field_{i + 1}": part for i, part in enumerate(parts)}
+
+
+def build_library(source, path, keys=None, parse=None, align="interpolate", row_group_size=ROW_GROUP_SIZE, workers=1):
+    """Pack spectrum files into a Parquet library at `path` and open it.
+
+    `source` is a folder (every spectra_io.FILETYPES file in it, sorted by
+    name) or a list of files. Every spectrum of every file becomes one
+    column named after it (file name, or the column header of wide CSVs).
+    Files on a different axis are interpolated onto the first file's axis
+    (align="interpolate", which the 2D-COS app needs) or merged onto the union
+    of all axes with NaN where a file has no point (align="merge", for
+    archives that must keep every measured point; the app refuses to
+    correlate those). Metadata comes from
+    `parse(name)`, by default `split_name(name, keys)`.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        paths = [os.path.join(source, file) for file in sorted(os.listdir(source))
+                 if file.lower().endswith(spectra_io.FILETYPES)]
+    else:
+        paths = list(source)
+    parse = parse or (lambda name: split_name(name, keys))
+
+    # Parsed once: load_spectra reads the same spectra_io cache as read_table
+    x, spectra = cos_engine.load_spectra(paths, align=align, workers=workers)
+    names, files = [], []
+    for file in paths:
+        columns = list(spectra_io.read_table(file).columns[1:])
+        names += columns
+        files += [os.path.basename(file)] * len(columns)
+    duplicates = sorted(name for name, count in Counter(names).items() if count > 1)
+    if duplicates:
+        raise ValueError(f"Spectrum names must be unique, found {', '.join(duplicates)} more than once")
+
+    # Ascending axis, so every row group covers one contiguous wavenumber range
+    if x[0] > x[-1]:
+        x, spectra = x[::-1], spectra[::-1]
+    valid = ~np.isnan(spectra)
+    metadata = []
+    for j, (name, file) in enumerate(zip(names, files)):
+        xj = x[valid[:, j]]
+        metadata.append({"name": name, "file": file, "points": int(len(xj)),
+                         "x_min": float(xj.min()), "x_max": float(xj.max()), **parse(name)})
+
+    frame = pd.DataFrame(spectra, columns=names)
+    frame.insert(0, "Wavenumber", x)
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata,
+                                           _META_KEY: json.dumps({"version": 1, "spectra": metadata})})
+    tmp = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp, row_group_size=row_group_size)
+    os.replace(tmp, path)
+    return SpectralLibrary(path)
+
+
+class SpectralLibrary:
+    """Read access to a library written by `build_library`."""
+
+    def __init__(self, path):
+        self.path = path
+        schema = pq.read_schema(path)
+        if _META_KEY not in (schema.metadata or {}):
+            raise ValueError(f"{path} is not a spectral library")
+        self.metadata = pd.DataFrame(json.loads(schema.metadata[_META_KEY])["spectra"])
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    @property
+    def names(self):
+        return list(self.metadata["name"])
+
+    def select(self, **criteria):
+        """Names of the spectra whose metadata matches every criterion, in library order.
+
+        A criterion is a value (equality), a list/tuple/set of accepted
+        values, or a callable taking the metadata column and returning a
+        boolean mask, e.g. date=lambda d: d.between("20241126", "20241129").
+        """
+        mask = np.ones(len(self.metadata), dtype=bool)
+        for key, wanted in criteria.items():
+            if key not in self.metadata:
+                raise KeyError(f"No metadata field {key!r}, the library has {', '.join(self.metadata.columns)}")
+            column = self.metadata[key]
+            if callable(wanted):
+                mask &= np.asarray(wanted(column), dtype=bool)
+            elif isinstance(wanted, (list, tuple, set)):
+                mask &= column.isin(wanted).to_numpy()
+            else:
+                mask &= (column == wanted).to_numpy()
+        return list(self.metadata["name"][mask])
+
+    def read_table(self, names=None, xlim=None):
+        """DataFrame with the Wavenumber column and the `names` spectra (all by default).
+
+        Only those columns are read, and with `xlim=(low, high)` only the row
+        groups overlapping that range. Rows are in ascending wavenumber order.
+        """
+        columns = None if names is None else ["Wavenumber", *names]
+        filters = None
+        if xlim is not None:
+            low, high = sorted(xlim)
+            filters = [("Wavenumber", ">=", low), ("Wavenumber", "<=", high)]
+        return pd.read_parquet(self.path, engine="pyarrow", columns=columns, filters=filters)
+
+    def read_spectra(self, names=None, xlim=None):
+        """(x, spectra) arrays of `read_table`, one spectrum per column."""
+        frame = self.read_table(names, xlim)
+        return frame["Wavenumber"].to_numpy(), frame.iloc[:, 1:].to_numpy(dtype=float)
@@ -0,0 +1,40 @@
+import numpy as np
+
+import cos_engine
+
+
+def test_stage_cache_skips_entries_larger_than_the_cache(tmp_path):
+    cache = cos_engine.StageCache(root=str(tmp_path), max_mb=0.1)
+    x = np.arange(100.0)
+    cache.put_spectra("small", x, np.ones((100, 10)))
+    assert "small" in cache
+
+    # 100 x 1000 float64 is 0.8 MB, more than the whole cache
+    cache.put("large", x, np.arange(1000.0), np.ones((100, 1000)))
+    assert "large" not in cache
+    assert "small" in cache
+    np.testing.assert_array_equal(cache.get_spectra("small")[1], np.ones((100, 10)))
+
+
+def test_stage_cache_fetch_map_still_returns_an_uncached_map(tmp_path):
+    cache = cos_engine.StageCache(root=str(tmp_path), max_mb=0.01)
+    x = np.arange(100.0)
+    data = cache.fetch_map("map", lambda: np.eye(100), x, x)
+    np.testing.assert_array_equal(data, np.eye(100))
+    assert cache.size() == 0
+
+
+def test_packed_maps_are_pooled_in_row_strips():
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=(37, 6))
+    x = np.arange(37.0)
+    cos = cos_engine.TwoDCOS(x, a, packed=True).compute()
+    dense = np.asarray(cos.asyn)
+
+    np.testing.assert_array_equal(cos.asyn.rows(5, 20), dense[5:20])
+    assert cos_engine.abs_max(cos.asyn) == np.abs(dense).max()
+    # A budget of a few rows forces many strips, which must match pooling the whole map at once
+    strips = cos_engine.pool_extremes(x, x, cos.asyn, memory_budget=1e-3)
+    whole = cos_engine.pool_extremes(x, x, dense)
+    for pooled, expected in zip(strips, whole):
+        np.testing.assert_array_equal(pooled, expected)
@@ -0,0 +1,36 @@
+import numpy as np
+
+import spectra_io
+
+
+def write(path, text):
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def test_dpt_export(tmp_path):
+    path = write(tmp_path / "sample.dpt", "3999.5,0.25\n3998.5,0.5\n3997.5,0.75\n")
+    layout = spectra_io.sniff(path)
+    assert (layout.delimiter, layout.decimal, layout.header, layout.descending) == (",", ".", None, True)
+
+    x, spectra = spectra_io.read_spectra(path)
+    np.testing.assert_allclose(x, [3999.5, 3998.5, 3997.5])
+    np.testing.assert_allclose(spectra[:, 0], [0.25, 0.5, 0.75])
+
+
+def test_european_export(tmp_path):
+    path = write(tmp_path / "european.csv",
+                 "Wavenumber;ACBCM_KMS0007;ACBCM_KMS0008\n4000;1,5;2,25\n3999,5;1,25;2\n3999;1;1,75\n")
+    layout = spectra_io.sniff(path)
+    assert (layout.delimiter, layout.decimal, layout.header, layout.columns) == (";", ",", 0, 3)
+
+    frame = spectra_io.read_table(path)
+    assert list(frame.columns) == ["Wavenumber", "ACBCM_KMS0007", "ACBCM_KMS0008"]
+    np.testing.assert_allclose(frame.to_numpy(), [[4000, 1.5, 2.25], [3999.5, 1.25, 2], [3999, 1, 1.75]])
+
+
+def test_european_export_without_header(tmp_path):
+    path = write(tmp_path / "european.txt", "4000\t1,5\n3999,5\t1,25\n")
+    x, spectra = spectra_io.read_spectra(path)
+    np.testing.assert_allclose(x, [4000, 3999.5])
+    np.testing.assert_allclose(spectra[:, 0], [1.5, 1.25])
@@ -0,0 +1,85 @@
+import queue
+import threading
+import weakref
+from time import monotonic
+
+
+class AcquisitionWorker(threading.Thread):
+    """Background thread that reads an instrument on a fixed schedule.
+
+    Reading k is started at start + k * interval on the monotonic clock, so
+    the time spent talking to the meter (or drawing the page) does not add up
+    over a run: a slow reading only shortens the wait before the next one.
+    Every result goes into `samples`, a thread-safe queue, as (k, record);
+    a failed reading is queued as (k, exception) and the run goes on. The
+    Streamlit script drains the queue whenever it redraws, and reruns of the
+    script do not touch the thread.
+    """
+
+    def __init__(self, read, interval, count):
+        super().__init__(daemon=True)
+        self.read = read
+        self.interval = float(interval)
+        self.count = int(count)
+        self.samples = queue.Queue()
+        self.done = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        start = monotonic()
+        for k in range(self.count):
+            if self._stop_event.wait(max(0.0, start + k * self.interval - monotonic())):
+                break
+            try:
+                self.samples.put((k, self.read()))
+            except Exception as e:
+                self.samples.put((k, e))
+            self.done = k + 1
+
+    def stop(self):
+        """Ask the thread to finish; the reading in progress is completed."""
+        self._stop_event.set()
+
+    @property
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    @property
+    def finished(self):
+        """True once the thread has ended and every sample has been drained."""
+        return not self.is_alive() and self.samples.empty()
+
+    def drain(self):
+        """Every (k, record or exception) queued since the last call, oldest first."""
+        items = []
+        while True:
+            try:
+                items.append(self.samples.get_nowait())
+            except queue.Empty:
+                return items
+
+
+def _release(instrument, workers):
+    for worker in list(workers.values()):
+        worker.stop()
+        # The reading in progress is completed, retries included
+        worker.join(timeout=instrument.exchange_timeout + 1)
+    workers.clear()
+    instrument.close()
+
+
+class InstrumentOwner:
+    """Ties an instrument session and its acquisition workers to one browser session.
+
+    Keep the owner in st.session_state next to them. `release()` stops every
+    worker in `workers` (a dict that may gain workers later) and closes the
+    instrument; it runs once, either when called or when the owner is garbage
+    collected with the session state of a closed tab, so an abandoned
+    recording does not keep reading the meter and holding its serial port.
+    """
+
+    def __init__(self, instrument, workers):
+        self._finalizer = weakref.finalize(self, _release, instrument, workers)
+
+    def release(self):
+        self._finalizer()
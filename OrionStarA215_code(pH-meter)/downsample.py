@@ -0,0 +1,61 @@
+import numpy as np
+
+METHODS = ("LTTB", "Min/Max")
+
+
+def _as_float(x):
+    x = np.asarray(x)
+    return x.view("int64").astype(float) if np.issubdtype(x.dtype, np.datetime64) else x.astype(float)
+
+
+def lttb(x, y, max_points):
+    """Indices of at most `max_points` points of (x, y) chosen by Largest-Triangle-Three-Buckets.
+
+    The first and last points are kept; in between, every bucket keeps the
+    point that forms the largest triangle with the point kept before it and
+    the average of the next bucket, which follows peaks and steps closely.
+    `x` may be numbers or datetime64.
+    """
+    n = len(y)
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+    xf, y = _as_float(x), np.asarray(y, dtype=float)
+
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    keep = np.empty(max_points, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(max_points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = xf[hi:next_hi].mean(), y[hi:next_hi].mean()
+        area = np.abs((xf[a] - avg_x) * (y[lo:hi] - y[a]) - (xf[a] - xf[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def min_max(x, y, max_points):
+    """Indices of the lowest and highest point of each of max_points / 2 equal buckets, in order.
+
+    Keeps every extreme of the trace (spikes are never dropped) at the cost
+    of a more jagged line than `lttb`.
+    """
+    n = len(y)
+    if max_points >= n or max_points < 2:
+        return np.arange(n)
+    y = np.asarray(y, dtype=float)
+    buckets = max_points // 2
+    bucket = np.arange(n) * buckets // n
+    order = np.lexsort((y, bucket))
+    starts = np.searchsorted(bucket[order], np.arange(buckets))
+    ends = np.append(starts[1:], n)
+    return np.unique(np.concatenate([order[starts], order[ends - 1]]))
+
+
+def downsample(x, y, max_points, method="LTTB"):
+    """(x, y) reduced to at most `max_points` points with `method`, one of METHODS, for display only."""
+    if method not in METHODS:
+        raise ValueError(f"Unknown downsampling {method!r}, expected one of {METHODS}")
+    keep = lttb(x, y, max_points) if method == "LTTB" else min_max(x, y, max_points)
+    return np.asarray(x)[keep], np.asarray(y)[keep]
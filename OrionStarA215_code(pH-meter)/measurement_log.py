@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+LOG_COLUMNS = {
+    "Date & Time": "datetime64[ns]",
+    "Elapsed Time": "float64",
+    "pH Value": "float64",
+    "mV Value": "float64",
+    "Temperature Value": "float64",
+}
+
+
+class MeasurementLog:
+    """Measurement table kept as one preallocated NumPy array per column.
+
+    Appending a reading writes one row in place, so a run costs the same per
+    sample at the end as at the start (instead of a pd.concat that copies the
+    whole table every time). `capacity` is the expected number of readings;
+    if a run goes past it the arrays double in size. `frame()` wraps the
+    filled part of the arrays in a DataFrame without copying, for display and
+    download only.
+    """
+
+    def __init__(self, capacity=1024, columns=LOG_COLUMNS):
+        self.dtypes = dict(columns)
+        self.size = 0
+        self.data = {name: np.empty(max(int(capacity), 1), dtype=dtype) for name, dtype in self.dtypes.items()}
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return len(next(iter(self.data.values())))
+
+    def _grow(self):
+        for name, values in self.data.items():
+            grown = np.empty(2 * len(values), dtype=values.dtype)
+            grown[:self.size] = values[:self.size]
+            self.data[name] = grown
+
+    def append(self, row):
+        """Add one reading, a {column: value} dict with every column of the log."""
+        if self.size == self.capacity:
+            self._grow()
+        for name, values in self.data.items():
+            values[self.size] = row[name]
+        self.size += 1
+
+    def column(self, name, start=0):
+        """Read-only view of one column from row `start` to the latest reading."""
+        view = self.data[name][start:self.size]
+        view.flags.writeable = False
+        return view
+
+    def last(self):
+        """The latest reading as a {column: value} dict, or None for an empty log."""
+        if not self.size:
+            return None
+        return {name: values[self.size - 1] for name, values in self.data.items()}
+
+    def frame(self):
+        """DataFrame over the filled rows, sharing memory with the log.
+
+        Every column goes in as its own Series with copy=False, the input
+        pandas promises not to copy or consolidate into one block.
+        """
+        return pd.DataFrame({name: pd.Series(self.column(name), copy=False) for name in self.data}, copy=False)
@@ -1,14 +1,23 @@
 import streamlit as st
 import pyvisa
 from pyvisa import constants
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import json
 from time import sleep
 from datetime import datetime
+from measurement_log import MeasurementLog
+from acquisition import AcquisitionWorker, InstrumentOwner
+from downsample import METHODS, downsample
+from visa_session import InstrumentSession, parse_record, parse_response
 
 time_label = datetime.now().strftime("%Y-%m-%d %H-%M")
 
+# Live chart per log column, in the order of the figure rows
+LIVE_TRACES = {"pH": "pH Value", "mV": "mV Value", "Temperature": "Temperature Value"}
+
 with open("electrode_list.json") as f:
     electrodes = json.load(f)
 
@@ -36,8 +45,10 @@ def config_streamlit():
     if "instrument" not in st.session_state:
         st.session_state["instrument"] = None
     if "data_log" not in st.session_state:
-        st.session_state["data_log"] = pd.DataFrame(
-            columns=["Date & Time", "pH Value", "mV Value", "Temperature Value"])
+        st.session_state["data_log"] = MeasurementLog()
+    if "acquisition" not in st.session_state:
+        # One background AcquisitionWorker per connected resource
+        st.session_state["acquisition"] = {}
 
 
 # Orion Star A215 settings
@@ -65,7 +76,7 @@ def list_resources():
 
 
 def connect_to_instrument(resource, settings):
-    """Establish connection to the instrument with specified settings."""
+    """Establish connection to the instrument with specified settings and start its command session."""
     try:
         rm = pyvisa.ResourceManager()
         inst = rm.open_resource(resource)
@@ -77,10 +88,14 @@ def connect_to_instrument(resource, settings):
         inst.write_termination = settings['line_break']
         inst.read_termination = settings['line_termination']
 
-        inst.write("SYSTEM")
-        response = inst.read()
+        session = InstrumentSession(inst, timeout=inst.timeout)
+        try:
+            response = session.query_sync("SYSTEM")
+        except Exception:
+            session.close()
+            raise
         st.write(f"Connected! Response: {response.strip('> ')}")
-        return inst
+        return session
     except pyvisa.errors.VisaIOError as e:
         st.error(f"Communication error with {resource}: {e} (Check if port is busy or device is on)")
     except Exception as e:
@@ -88,19 +103,11 @@ def connect_to_instrument(resource, settings):
     return None
 
 
-def get_measurement(inst):
-    """Retrieve a single measurement from the instrument."""
-    try:
-        if not inst:
-            raise ValueError("No instrument connected")
-        inst.write("GETMEAS")
-        response = inst.read()
-        lines = response.strip('> ').split('\r')
-        measurement_line = lines[3] if len(lines) > 3 else lines[0]
-        return [item.strip() for item in measurement_line.split(",")]
-    except Exception as e:
-        st.error(f"Measurement failed: {e}")
-        return None
+def read_measurement(inst):
+    """Retrieve a single measurement from the instrument, raising on failure (safe to call from a thread)."""
+    if not inst:
+        raise ValueError("No instrument connected")
+    return parse_record(inst.query_sync("GETMEAS"))
 
 
 def get_measurement2(inst, time_step=5):
@@ -109,11 +116,7 @@ def get_measurement2(inst, time_step=5):
     try:
         if not inst:
             raise ValueError("No instrument connected")
-        inst.write(f"GETMEASTIMED CH_1 {step}")
-        response = inst.read()
-        lines = response.strip('> ').split('\r')
-        measurement_line = lines[3] if len(lines) > 3 else lines[0]
-        return [item.strip() for item in measurement_line.split(",")]
+        return parse_record(inst.query_sync(f"GETMEASTIMED CH_1 {step}"))
     except Exception as e:
         st.error(f"Measurement failed: {e}")
         return None
@@ -124,11 +127,7 @@ def stop(inst):
     try:
         if not inst:
             raise ValueError("No instrument connected")
-        inst.write("STOP")
-        response = inst.read()
-        lines = response.strip('> ').split('\r')
-        measurement_line = lines[3] if len(lines) > 3 else lines[0]
-        return [item.strip() for item in measurement_line.split(",")]
+        return parse_record(inst.query_sync("STOP"))
     except Exception as e:
         st.error(f"Measurement failed: {e}")
         return None
@@ -141,9 +140,7 @@ def get_log(inst, lower_limit, upper_limit):
     try:
         if not inst:
             raise ValueError("No instrument connected")
-        inst.write(f"GETLOG {lower} {upper}")
-        response = inst.read()
-        lines = response.strip('> ').split('\r\n')
+        lines = parse_response(inst.query_sync(f"GETLOG {lower} {upper}"), '\r\n')
         data_lines = [line for line in lines if line and not line.startswith(('End of Data', 'GETLOG'))]
 
         if not data_lines:
@@ -172,6 +169,46 @@ def get_log(inst, lower_limit, upper_limit):
         return None
 
 
+def drain_samples(worker, data_log):
+    """Move the readings queued by an acquisition worker into the measurement log."""
+    for _, record in worker.drain():
+        if isinstance(record, Exception):
+            st.error(f"Measurement failed: {record}")
+            continue
+        timestamp = pd.to_datetime(record[4], format="%d/%m/%y %H:%M:%S")
+        start_time = pd.Timestamp(data_log.column("Date & Time")[0]) if len(data_log) else timestamp
+        data_log.append({
+            "Date & Time": timestamp,
+            "Elapsed Time": (timestamp - start_time).total_seconds(),
+            "pH Value": float(record[8]),
+            "mV Value": float(record[10]),
+            "Temperature Value": float(record[12])
+        })
+
+
+def update_figure(fig, data_log, max_points, method):
+    """Point the pH, mV and temperature traces at the log, downsampled to `max_points` each for display."""
+    times = data_log.column("Date & Time")
+    for trace, column in zip(fig.data, ["pH Value", "mV Value", "Temperature Value"]):
+        trace.x, trace.y = downsample(times, data_log.column(column), max_points, method)
+
+
+def live_rows(data_log, name, start=0):
+    """Readings of one LIVE_TRACES column from row `start` on, indexed by time, for st.line_chart.add_rows."""
+    times = pd.Index(data_log.column("Date & Time", start), name="Date & Time")
+    return pd.DataFrame({name: data_log.column(LIVE_TRACES[name], start)}, index=times)
+
+
+def live_seed(data_log, name, max_points, method):
+    """Rows a live chart is (re)started from: the latest max_points / 2 readings as they are,
+    after the earlier history downsampled to max_points / 4 points."""
+    times, values = data_log.column("Date & Time"), data_log.column(LIVE_TRACES[name])
+    window = max(0, len(times) - max_points // 2)
+    history_x, history_y = downsample(times[:window], values[:window], max_points // 4, method)
+    index = pd.Index(np.concatenate([history_x, times[window:]]), name="Date & Time")
+    return pd.DataFrame({name: np.concatenate([history_y, values[window:]])}, index=index)
+
+
 def convert_for_download(df):
     return df.to_csv().encode("utf-8")
 
@@ -214,6 +251,7 @@ with st.container(border=True):
             inst = connect_to_instrument(selected_resource, orion_settings)
             if inst:
                 st.session_state["instrument"] = inst
+                st.session_state["owner"] = InstrumentOwner(inst, st.session_state["acquisition"])
                 st.session_state["selected_resource"] = selected_resource
                 st.session_state["connected"] = True
                 st.rerun()
@@ -221,7 +259,8 @@ with st.container(border=True):
         st.success(f"Connected to {st.session_state['selected_resource']}!")
         st.info("ℹ️ Don't forget to disconnect the instrument")
         if st.button("Disconnect"):
-            st.session_state["instrument"].close()
+            # Stops the recording, if any, and closes the instrument
+            st.session_state["owner"].release()
             st.session_state["instrument"] = None
             st.session_state["connected"] = False
             st.rerun()
@@ -237,8 +276,9 @@ with online_meas:
     st.write('''
     #### README
     This mode of measurement display real time data coming from the pH-meter every a set time step. 
-    However, this measurement set up creates a delay in response (about 0.5s) regardless of the time step. Beware that the time
-    elapsed is not a fixed time step. Still the `Date & Time` column is coming from the meter and is totally accurate. 
+    The meter is read in the background on a fixed schedule, so the time step does not drift with the plot refresh,
+    and the recording keeps going if the page reruns. The meter still takes a moment to answer, so the `Date & Time`
+    column, which comes from the meter, is the accurate time of each reading. 
     ''')
     parm_column, display_col = st.columns((1, 2), gap='medium')
     with parm_column:
@@ -249,55 +289,92 @@ with online_meas:
         with col2:
             time_step = st.number_input("Time step (s)", min_value=5, max_value=17400, step=5)
         steps = int((duration * 60) / time_step)
+        refresh = st.number_input("Plot refresh (s)", min_value=1, max_value=60, value=2, step=1,
+                                  help="How often the plot and progress are redrawn while recording")
+        col3, col4 = st.columns(2)
+        with col3:
+            max_points = st.number_input("Max points per trace", min_value=100, max_value=20000, value=2000, step=100,
+                                         help="Longer runs are downsampled for the plot only, the CSV keeps every reading")
+        with col4:
+            method = st.selectbox("Downsampling", options=METHODS,
+                                  help="LTTB follows the shape of the curve, Min/Max keeps every spike")
+        incremental = st.toggle("Incremental live plot", value=True,
+                                help="While recording, only send the new points to the browser on each refresh, "
+                                     "so long runs keep a constant cost per refresh. Past Max points the live charts "
+                                     "restart from the recent readings and a downsampled history. "
+                                     "The full plot is drawn at the end.")
 
     with display_col:
-        # Initialize figure with proper layout
-        fig = go.Figure(
-            layout={
-                "title": {"text": "pH vs Time"},
-                "xaxis_title": "Time",
-                "yaxis_title": "pH",
-            }
-        )
-        # Add an empty scatter trace to update later
-        fig.add_trace(go.Scatter(x=[], y=[], mode="lines+markers", name="pH"))
-        plot_placeholder = st.plotly_chart(fig, use_container_width=True)
+        # Initialize figure with proper layout, pH on top with mV and temperature below on the same time axis
+        fig = make_subplots(rows=3, cols=1, shared_xaxes=True, row_heights=[0.5, 0.25, 0.25], vertical_spacing=0.04)
+        fig.update_layout(title={"text": "pH vs Time"}, height=700)
+        fig.update_xaxes(title_text="Time", row=3, col=1)
+        for row, (name, unit) in enumerate([("pH", "pH"), ("mV", "mV"), ("Temperature", "Temperature")], start=1):
+            # Add an empty scatter trace to update later
+            fig.add_trace(go.Scatter(x=[], y=[], mode="lines+markers", name=name), row=row, col=1)
+            fig.update_yaxes(title_text=unit, row=row, col=1)
+        plot_placeholder = st.empty()
+        plot_placeholder.plotly_chart(fig, use_container_width=True)
         status_placeholder = st.empty()
 
-        if st.button("Record pH", type="primary"):
-            st.session_state["data_log"] = pd.DataFrame(
-                columns=["Date & Time", "Elapsed Time", "pH Value", "mV Value", "Temperature Value"])
-            start_time = None
+        resource = st.session_state["selected_resource"]
+        worker = st.session_state["acquisition"].get(resource)
+        recording = worker is not None and not worker.finished
+
+        record_col, stop_col = st.columns(2)
+        if record_col.button("Record pH", type="primary", disabled=recording):
+            # Sized for the whole run, so every reading is written in place
+            st.session_state["data_log"] = MeasurementLog(capacity=steps)
+            inst = st.session_state["instrument"]
+            worker = AcquisitionWorker(lambda: read_measurement(inst), interval=time_step, count=steps)
+            st.session_state["acquisition"][resource] = worker
+            worker.start()
+            recording = True
+        if stop_col.button("Stop Recording", disabled=not recording):
+            worker.stop()
+
+        if recording:
+            data_log = st.session_state["data_log"]
+            live_charts, sent, shown = None, 0, 0
             with st.spinner("Recording pH..."):
-                for cycle in range(steps):
-                    record = get_measurement(st.session_state["instrument"])
-                    if record:
-                        timestamp = pd.to_datetime(record[4], format="%d/%m/%y %H:%M:%S")
-                        if start_time is None:
-                            start_time = timestamp
-                        elapsed_time = (timestamp - start_time).total_seconds()
-
-                        data = {
-                            "Date & Time": timestamp,
-                            "Elapsed Time": elapsed_time,
-                            "pH Value": float(record[8]),
-                            "mV Value": float(record[10]),
-                            "Temperature Value": float(record[12])
-                        }
-                        st.session_state["data_log"] = pd.concat(
-                            [st.session_state["data_log"], pd.DataFrame([data])], ignore_index=True
-                        )
-
-                        # Update the existing trace with the full dataset
-                        fig.data[0].x = st.session_state["data_log"]["Date & Time"]
-                        fig.data[0].y = st.session_state["data_log"]["pH Value"]
+                # Redraw at the refresh rate while the worker keeps its own schedule
+                while True:
+                    drain_samples(worker, data_log)
+
+                    if not incremental:
+                        # Update the existing traces with the (downsampled) full dataset
+                        update_figure(fig, data_log, max_points, method)
                         plot_placeholder.plotly_chart(fig, use_container_width=True)
-                        status_placeholder.write(f"Progress: {cycle + 1}/{steps} measurements")
-                        sleep(time_step)
-                status_placeholder.write("Recording complete!")
-            parm_column.write(st.session_state["data_log"])
+                    elif len(data_log) > sent:
+                        if live_charts is None or shown + len(data_log) - sent > max_points:
+                            # (Re)start the charts from a recent window and a downsampled history,
+                            # so the browser never holds more than max_points per trace
+                            seeds = {name: live_seed(data_log, name, max_points, method) for name in LIVE_TRACES}
+                            with plot_placeholder.container():
+                                live_charts = {name: st.line_chart(seed, x_label="Time", y_label=name, height=220)
+                                               for name, seed in seeds.items()}
+                            shown = max(len(seed) for seed in seeds.values())
+                        else:
+                            # Only the readings since the last refresh go to the browser
+                            for name, chart in live_charts.items():
+                                chart.add_rows(live_rows(data_log, name, sent))
+                            shown += len(data_log) - sent
+                        sent = len(data_log)
+                    status_placeholder.write(f"Progress: {worker.done}/{worker.count} measurements")
+                    if worker.finished:
+                        break
+                    sleep(refresh)
+            # Redraw the page with the run over, so the buttons here and in the timed tab are enabled again
+            st.rerun()
+
+        if worker is not None:
+            status_placeholder.write("Recording stopped." if worker.stopped else "Recording complete!")
+        if len(st.session_state["data_log"]):
+            update_figure(fig, st.session_state["data_log"], max_points, method)
+            plot_placeholder.plotly_chart(fig, use_container_width=True)
+            parm_column.write(st.session_state["data_log"].frame())
 
-        csv = convert_for_download(st.session_state["data_log"])
+        csv = convert_for_download(st.session_state["data_log"].frame())
         parm_column.download_button(
             label="Download CSV",
             data=csv,
@@ -314,7 +391,9 @@ with timed_meas:
                                       min_value=3, step=1, max_value=3600,
                                       help="Minimum every 3 seconds / Maximum every 3600 seconds")
 
-    if st.button("Time Measurement", key='time_button'):
+    if recording:
+        st.warning("The pH meter is busy with the online measurement, stop it to start or stop a timed measurement.")
+    if st.button("Time Measurement", key='time_button', disabled=recording):
         time_measurement_response = get_measurement2(st.session_state["instrument"], time_step=fixed_time_step)
         if len(time_measurement_response) >= 1:
             st.write(f'''
@@ -327,7 +406,7 @@ with timed_meas:
     Click the stop button to finish recording.  
     🚨 :red[If you don't click stop the meter will continue to log datapoints endlessly.]
     ''')
-    if st.button("Stop"):
+    if st.button("Stop", disabled=recording):
         stop(st.session_state["instrument"])
     st.write("""
     Click the **log view** button on the pH meter and find the initial and final **SNo** (record number) of
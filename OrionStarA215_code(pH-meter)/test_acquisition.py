@@ -0,0 +1,29 @@
+import gc
+
+from acquisition import AcquisitionWorker, InstrumentOwner
+
+
+class FakeInstrument:
+    exchange_timeout = 1
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_dropped_owner_stops_the_recording_and_closes_the_instrument():
+    instrument, workers = FakeInstrument(), {}
+    owner = InstrumentOwner(instrument, workers)
+    worker = AcquisitionWorker(lambda: "reading", interval=60, count=10)
+    workers["ASRL8::INSTR"] = worker
+    worker.start()
+
+    # What happens to the session state of a closed browser tab
+    del owner
+    gc.collect()
+    assert not worker.is_alive()
+    assert worker.stopped
+    assert instrument.closed
+    assert workers == {}
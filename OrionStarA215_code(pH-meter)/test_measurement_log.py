@@ -0,0 +1,27 @@
+import numpy as np
+
+from measurement_log import LOG_COLUMNS, MeasurementLog
+
+
+def reading(k):
+    return {"Date & Time": np.datetime64("2025-01-01T12:00:00") + np.timedelta64(k, "s"),
+            "Elapsed Time": float(k), "pH Value": 7.0 + k / 100, "mV Value": -2.0 * k, "Temperature Value": 25.0}
+
+
+def test_append_grows_past_capacity():
+    log = MeasurementLog(capacity=2)
+    for k in range(5):
+        log.append(reading(k))
+    assert len(log) == 5 and log.capacity == 8
+    np.testing.assert_array_equal(log.column("Elapsed Time"), [0, 1, 2, 3, 4])
+    assert log.last()["pH Value"] == 7.04
+
+
+def test_frame_shares_memory_with_the_log():
+    log = MeasurementLog(capacity=16)
+    for k in range(3):
+        log.append(reading(k))
+    frame = log.frame()
+    assert list(frame.columns) == list(LOG_COLUMNS) and len(frame) == 3
+    for name in LOG_COLUMNS:
+        assert np.shares_memory(frame[name].to_numpy(), log.data[name]), name
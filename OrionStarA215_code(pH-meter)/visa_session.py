@@ -0,0 +1,137 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pyvisa
+from pyvisa import constants
+
+# Commands that only read the meter, so sending one again after a timeout does no harm.
+# GETMEASTIMED and STOP change what the meter is doing and are never repeated.
+IDEMPOTENT_COMMANDS = ("SYSTEM", "GETMEAS", "GETLOG")
+
+
+def parse_response(response, line_break='\r'):
+    """Lines of a meter response, without the '>' prompt around it."""
+    return response.strip('> ').split(line_break)
+
+
+def parse_record(response):
+    """Fields of the measurement line of a GETMEAS / GETMEASTIMED / STOP response."""
+    lines = parse_response(response)
+    measurement_line = lines[3] if len(lines) > 3 else lines[0]
+    return [item.strip() for item in measurement_line.split(",")]
+
+
+class InstrumentSession:
+    """Asyncio command queue in front of one open VISA resource.
+
+    An event loop on a background thread takes commands from a queue one at
+    a time and runs each write + read on a single I/O thread, so commands
+    from the acquisition thread and from the page follow each other on the
+    serial link without ever overlapping. Each exchange uses its own VISA
+    timeout (ms); a VisaIOError on one of the IDEMPOTENT_COMMANDS is retried
+    `retries` times, waiting `backoff`, 2 * `backoff`, ... seconds in
+    between, and raised to the caller if the last attempt fails too. Other
+    commands are sent once. After a failed exchange the read buffer is
+    discarded before the next command is written, so a late answer is not
+    taken for the next one.
+
+    `query` is for coroutines on the session loop; `request` and
+    `query_sync` can be called from any thread, and raise RuntimeError once
+    the session is closed.
+    """
+
+    def __init__(self, inst, timeout=5000, retries=2, backoff=0.5):
+        self.inst = inst
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.closed = False
+        self._stale = False
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="visa-io")
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    async def _start(self):
+        self._queue = asyncio.Queue()
+        self._server = asyncio.create_task(self._serve())
+
+    async def _serve(self):
+        while True:
+            command, timeout, future = await self._queue.get()
+            if future.cancelled():
+                continue
+            try:
+                result = await self._exchange(command, timeout)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+    @property
+    def exchange_timeout(self):
+        """Longest a single command can take with every retry and backoff, in seconds."""
+        return (self.retries + 1) * self.timeout / 1000 + self.backoff * (2 ** self.retries - 1)
+
+    def _write_read(self, command, timeout, discard):
+        if discard:
+            # Drop whatever is left of the failed answer before asking again
+            self.inst.flush(constants.BufferOperation.discard_read_buffer)
+        self.inst.timeout = timeout
+        self.inst.write(command)
+        return self.inst.read()
+
+    async def _exchange(self, command, timeout):
+        retries = self.retries if command.split()[0] in IDEMPOTENT_COMMANDS else 0
+        for attempt in range(retries + 1):
+            try:
+                response = await self.loop.run_in_executor(self._io, self._write_read, command, timeout, self._stale)
+            except pyvisa.errors.VisaIOError:
+                self._stale = True
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+            else:
+                self._stale = False
+                return response
+
+    def _check_open(self):
+        if self.closed:
+            raise RuntimeError("The instrument session is closed")
+
+    async def query(self, command, timeout=None):
+        """Queue `command` and return the raw response once it is its turn and it has been answered."""
+        self._check_open()
+        future = self.loop.create_future()
+        await self._queue.put((command, timeout or self.timeout, future))
+        return await future
+
+    def request(self, command, timeout=None):
+        """Queue `command` from any thread; returns a concurrent.futures.Future of the raw response."""
+        self._check_open()
+        return asyncio.run_coroutine_threadsafe(self.query(command, timeout), self.loop)
+
+    def query_sync(self, command, timeout=None):
+        """Queue `command` and block the calling thread until it has been answered."""
+        return self.request(command, timeout).result()
+
+    def close(self):
+        """Stop the queue (pending commands are cancelled) and close the resource."""
+        if self.closed:
+            return
+        self.closed = True
+
+        async def shutdown():
+            self._server.cancel()
+            while not self._queue.empty():
+                self._queue.get_nowait()[2].cancel()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._io.shutdown(wait=True)
+        self.inst.close()